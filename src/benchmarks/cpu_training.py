@@ -0,0 +1,124 @@
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from transformers import HfArgumentParser, Seq2SeqTrainingArguments, TrainerCallback, set_seed
+
+from ..models.finetune import build_trainer
+from ..utilities.cpu import configure_cpu_training, cpu_supports_bf16
+from ..utilities.setup_parameters import ModelArguments, DynamicDataTrainingArguments
+
+logger = logging.getLogger(__name__)
+
+
+class StepTimer(TrainerCallback):
+    """
+    Times the optimizer steps after the warm-up ones, which include torch.compile and allocator warm-up.
+    """
+    def __init__(self, warmup_steps):
+        self.warmup_steps = warmup_steps
+        self.step_ends = []
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.step_ends.append(time.perf_counter())
+
+    def steps_per_sec(self):
+        timed = self.step_ends[self.warmup_steps - 1:] if self.warmup_steps > 0 else self.step_ends
+        if len(timed) < 2:
+            return None
+        return (len(timed) - 1) / (timed[-1] - timed[0])
+
+
+def run_config(params_file, config, warmup_steps, steps):
+    """
+    Trains a few steps of the params file with one CPU configuration, in its own process,
+    since the inter-op thread count can only be set once per process.
+    """
+    with open(params_file) as f:
+        params = json.load(f)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        params.update(
+            output_dir=output_dir, max_steps=warmup_steps + steps, eval_strategy="no", evaluation_strategy="no",
+            save_strategy="no", logging_strategy="no", report_to=[],
+            bf16=config["bf16"], torch_compile=config["torch_compile"],
+            torch_intra_op_threads=config["intra_op_threads"], torch_inter_op_threads=config["inter_op_threads"],
+            cpu_bf16_auto=False)
+        model_args, data_args, training_args = HfArgumentParser(
+            (ModelArguments, DynamicDataTrainingArguments, Seq2SeqTrainingArguments)).parse_dict(params)
+
+        set_seed(training_args.seed)
+        training_args = configure_cpu_training(data_args, training_args)
+        timer = StepTimer(warmup_steps)
+        try:
+            trainer = build_trainer(model_args, data_args, training_args)
+            trainer.add_callback(timer)
+            trainer.train()
+        except Exception as e:
+            # e.g. no compiler for torch.compile, the other configurations are still compared
+            logger.warning("Configuration %s failed: %s", config, e)
+            return dict(config, steps_per_sec=None, error=str(e))
+
+    return dict(config, steps_per_sec=timer.steps_per_sec())
+
+
+def benchmark_configs(params_file, configs, warmup_steps=3, steps=10):
+    results = []
+    for config in configs:
+        # spawn, so every configuration starts from fresh torch thread pools
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results.append(executor.submit(run_config, params_file, config, warmup_steps, steps).result())
+        logger.info("%s: %s steps/sec", config, results[-1]["steps_per_sec"])
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--params", default="./params/flan-t5-base-dbbook-prompt-4.json")
+    parser.add_argument("--warmup-steps", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--intra-op-threads", type=int, nargs="+", default=[None])
+    parser.add_argument("--inter-op-threads", type=int, nargs="+", default=[None])
+    parser.add_argument("--no-bf16", action="store_true", help="Only benchmark fp32")
+    parser.add_argument("--no-compile", action="store_true", help="Only benchmark eager execution")
+    parser.add_argument("--output", default="results/cpu_training.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    bf16_options = [False] if args.no_bf16 or not cpu_supports_bf16() else [False, True]
+    compile_options = [False] if args.no_compile else [False, True]
+    configs = [
+        {"bf16": bf16, "torch_compile": torch_compile, "intra_op_threads": intra, "inter_op_threads": inter}
+        for bf16, torch_compile, intra, inter in itertools.product(
+            bf16_options, compile_options, args.intra_op_threads, args.inter_op_threads)
+    ]
+
+    results = benchmark_configs(args.params, configs, args.warmup_steps, args.steps)
+
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump({"params_file": args.params, "warmup_steps": args.warmup_steps, "steps": args.steps, "results": results}, f, indent=2)
+
+    for result in sorted(results, key=lambda result: -(result["steps_per_sec"] or 0)):
+        rate = f"{result['steps_per_sec']:.3f} steps/sec" if result["steps_per_sec"] is not None else "failed"
+        print(
+            f"bf16={result['bf16']} torch_compile={result['torch_compile']} "
+            f"intra_op_threads={result['intra_op_threads']} inter_op_threads={result['inter_op_threads']}: {rate}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+from pathlib import Path
+
+import torch
+
+from torch.utils.data import DataLoader
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, DataCollatorForSeq2Seq, HfArgumentParser
+
+from ..data import build_users_profiles, map_item_features, train_dev_split, truncate_texts
+from ..data.paths import PROCESSED_DATA_PATH, RAW_DATA_PATH
+from ..data.processors import DbbookProcessor, processors_mapping
+from ..data.t5dataset import T5EvalAsRankDataset, tokenize_multipart_input
+from ..data.templates import compile_template
+from ..data.text_store import open_text_store, open_token_store
+from ..models.results import RankingWriter
+from ..models.scoring import RankingScorer, get_verbalizer_token_ids
+from ..utilities.setup_parameters import DynamicDataTrainingArguments
+from .synthetic import generate_dbbook, train_tiny_t5
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE = (
+    "We will describe a book and the reading tastes of the reader, we want to know if such book is a good fit "
+    "for the reader. *item_text*. User likes the book genres: *user_genres*, will he appreciate the book?"
+)
+MAPPING = "{0:'No', 1:'Yes'}"
+
+
+def timed(fn, repeats=1):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def summarize(times, items=None):
+    seconds = statistics.median(times)
+    summary = {"seconds": seconds, "min_seconds": min(times), "repeats": times}
+    if items is not None:
+        summary["items"] = items
+        summary["items_per_sec"] = items / max(seconds, 1e-9)
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_data(scale, seed, benchmarks):
+    """
+    Synthetic raw data through the dvc stages, the stages are timed as well.
+    """
+    _, times = timed(lambda: generate_dbbook(seed=seed, **scale))
+    benchmarks["generate"] = summarize(times)
+
+    corpus_path = Path("corpus.txt")
+    texts = [path.read_text() for path in sorted((RAW_DATA_PATH / "dbbook" / "texts").iterdir())]
+    corpus_path.write_text("\n".join(texts + [TEMPLATE]))
+    model_path = train_tiny_t5("models/tiny-t5", corpus_path, seed=seed)
+
+    _, times = timed(map_item_features.main)
+    benchmarks["stage.map_item_features"] = summarize(times)
+
+    _, times = timed(lambda: train_dev_split.main({"dataset": "dbbook", "dev_size": 0.2, "strategy": "fraction", "seed": seed}))
+    benchmarks["stage.train_dev_split"] = summarize(times)
+
+    _, times = timed(build_users_profiles.main)
+    benchmarks["stage.build_users_profiles"] = summarize(times)
+
+    truncate_args = HfArgumentParser((DynamicDataTrainingArguments)).parse_dict(
+        {"task_name": "truncate", "data_dir": str(RAW_DATA_PATH / "dbbook"), "max_seq_length": 128, "always_preprocess": True})[0]
+    _, times = timed(lambda: truncate_texts.main(truncate_args, tokenizer_name_or_path=model_path))
+    benchmarks["stage.truncate_texts"] = summarize(times, items=len(texts))
+
+    return model_path
+
+
+def run_benchmarks(scale, seed=42, repeats=3, batch_size=32):
+    benchmarks = {}
+    model_path = prepare_data(scale, seed, benchmarks)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    data_args = HfArgumentParser((DynamicDataTrainingArguments)).parse_dict(
+        {"task_name": "dbbook_ranking", "data_dir": str(PROCESSED_DATA_PATH / "dbbook"), "template": TEMPLATE, "mapping": MAPPING})[0]
+
+    def get_examples():
+        # a new processor and store, so every repeat reads from disk
+        open_text_store.cache_clear()
+        return DbbookProcessor("dbbook").get_examples(mode="train")
+
+    examples, times = timed(get_examples, repeats)
+    benchmarks["processor.get_examples"] = summarize(times, items=len(examples))
+
+    features, times = timed(lambda: [
+        tokenize_multipart_input(example=example, tokenizer=tokenizer, template=TEMPLATE)
+        for example in examples
+    ], repeats)
+    benchmarks["tokenize_multipart_input"] = summarize(times, items=len(examples))
+
+    open_token_store.cache_clear()
+    compiled_template = compile_template(TEMPLATE, tokenizer)
+    _, times = timed(lambda: [
+        tokenize_multipart_input(example=example, tokenizer=tokenizer, template=TEMPLATE, compiled_template=compiled_template)
+        for example in examples
+    ], repeats)
+    benchmarks["tokenize_multipart_input.compiled_template"] = summarize(times, items=len(examples))
+
+    label_to_word = eval(MAPPING)
+    label_ids = {label: tokenizer(word).input_ids for label, word in label_to_word.items()}
+    for feature, example in zip(features, examples):
+        feature["labels"] = label_ids[example["label"]]
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_path).eval()
+    data_collator = DataCollatorForSeq2Seq(tokenizer, model=model, padding=True)
+    _, times = timed(lambda: [
+        data_collator(features[start:start + batch_size])
+        for start in range(0, len(features), batch_size)
+    ], repeats)
+    benchmarks["data_collator"] = summarize(times, items=len(features))
+
+    labels = processors_mapping["dbbook_ranking"].get_labels()
+    scorer = RankingScorer(
+        model,
+        token_ids=get_verbalizer_token_ids(tokenizer, label_to_word, labels),
+        positive_index=labels.index(1))
+    dataset = T5EvalAsRankDataset(data_args, tokenizer=tokenizer)
+    batches = list(DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=data_collator))
+
+    def score():
+        scores = {}
+        for batch in batches:
+            batch_scores = scorer(batch["input_ids"], batch["attention_mask"])
+            for user_id, item_id, value in zip(batch["user_id"].tolist(), batch["item_id"].tolist(), batch_scores.tolist()):
+                scores.setdefault(user_id, {})[item_id] = value
+        return scores
+
+    scores, times = timed(score, repeats)
+    benchmarks["ranking.score"] = summarize(times, items=len(dataset))
+
+    def write_results(binary):
+        with RankingWriter(Path("results") / "benchmark", binary=binary) as writer:
+            for user_id, user_scores in scores.items():
+                writer.write(user_id, user_scores)
+
+    _, times = timed(lambda: write_results(binary=False), repeats)
+    benchmarks["results.write"] = summarize(times, items=len(dataset))
+    _, times = timed(lambda: write_results(binary=True), repeats)
+    benchmarks["results.write.binary"] = summarize(times, items=len(dataset))
+
+    return benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--train-per-user", type=int, default=40)
+    parser.add_argument("--test-per-user", type=int, default=20)
+    parser.add_argument("--text-words", type=int, default=120)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", default=None, help="Directory of the synthetic data, a temporary one if not set")
+    parser.add_argument("--output", default="results/benchmarks.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.WARN,
+    )
+
+    scale = {
+        "num_users": args.users,
+        "num_items": args.items,
+        "train_per_user": args.train_per_user,
+        "test_per_user": args.test_per_user,
+        "text_words": args.text_words,
+    }
+    output_path = Path(args.output).absolute()
+    commit = git_commit()
+
+    # data paths are relative to the working directory, so the pipeline runs inside the workdir
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = Path(args.workdir or tmp_dir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        os.chdir(workdir)
+        try:
+            torch.manual_seed(args.seed)
+            benchmarks = run_benchmarks(scale, seed=args.seed, repeats=args.repeats, batch_size=args.batch_size)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "cpu_count": os.cpu_count(),
+        "scale": dict(scale, repeats=args.repeats, batch_size=args.batch_size, seed=args.seed),
+        "benchmarks": benchmarks,
+    }
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, benchmark in benchmarks.items():
+        rate = f" ({benchmark['items_per_sec']:.1f} items/sec)" if "items_per_sec" in benchmark else ""
+        print(f"{name}: {benchmark['seconds']:.4f}s{rate}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import random
+
+from pathlib import Path
+
+from ..data.map_item_features import RESOURCE_PREFIX, SINGLE_PROPERTIES, SUBJECT_PROPERTY
+from ..data.paths import RAW_DATA_PATH
+
+PROPERTY_TYPES = {feature: property_type for property_type, feature in SINGLE_PROPERTIES.items()}
+LABEL_WORDS = ["Yes", "No"]
+
+
+def make_words(rng, count):
+    return ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(3, 9))) for _ in range(count)]
+
+
+def generate_dbbook(
+    num_users=200,
+    num_items=1000,
+    train_per_user=40,
+    test_per_user=20,
+    text_words=120,
+    num_genres=20,
+    subjects_per_item=3,
+    seed=42,
+    data_dir=RAW_DATA_PATH / "dbbook",
+):
+    """
+    Writes a random dataset in the raw dbbook layout: train and test interactions, item texts,
+    item properties and the entities they map to. Users prefer books of a few genres.
+    """
+    rng = random.Random(seed)
+    data_dir = Path(data_dir)
+    (data_dir / "texts").mkdir(parents=True, exist_ok=True)
+    (data_dir / "item-prop").mkdir(parents=True, exist_ok=True)
+
+    vocabulary = make_words(rng, 5000) + LABEL_WORDS
+    genres = [f"Genre_{genre}" for genre in range(num_genres)]
+    entities = {}
+
+    def entity_id(uri):
+        return entities.setdefault(uri, len(entities))
+
+    item_genres = {}
+    item_props = []
+    for item_id in range(1, num_items + 1):
+        item_genres[item_id] = rng.choice(genres)
+        properties = [
+            ("author", f"Author_{rng.randrange(num_items // 4 + 1)}"),
+            ("genre", f"{item_genres[item_id]}_(genre)"),
+            ("series", f"Series_{rng.randrange(num_items // 8 + 1)}"),
+            ("publisher", f"Publisher_{rng.randrange(50)}"),
+        ]
+        for feature, name in properties:
+            item_props.append((item_id, entity_id(RESOURCE_PREFIX + name), PROPERTY_TYPES[feature]))
+        for _ in range(subjects_per_item):
+            subject = f"Category:Subject_{rng.randrange(num_items // 2 + 1)}"
+            item_props.append((item_id, entity_id(RESOURCE_PREFIX + subject), SUBJECT_PROPERTY))
+
+        text = " ".join(rng.choices(vocabulary, k=rng.randint(text_words // 2, text_words * 3 // 2)))
+        (data_dir / "texts" / f"{item_id}.text").write_text(text)
+
+    with open(data_dir / "item-prop" / "train.tsv", "w") as f:
+        f.write("".join(f"{item_id}\t{entity}\t{property_type}\n" for item_id, entity, property_type in item_props))
+
+    # map_item_features reads the entities with header=1, so there are two header lines
+    with open(data_dir / "mapping_entities.tsv", "w") as f:
+        f.write(f"{len(entities)}\nid\tprop\n")
+        f.write("".join(f"{entity}\t{uri}\n" for uri, entity in entities.items()))
+
+    items = list(item_genres.keys())
+    train_rows, test_rows = [], []
+    for user_id in range(num_users):
+        liked = set(rng.sample(genres, 3))
+        sampled = rng.sample(items, min(train_per_user + test_per_user, len(items)))
+        for position, item_id in enumerate(sampled):
+            label = int(rng.random() < (0.8 if item_genres[item_id] in liked else 0.3))
+            (train_rows if position < train_per_user else test_rows).append(f"{user_id}\t{item_id}\t{label}\n")
+
+    (data_dir / "train.tsv").write_text("".join(train_rows))
+    (data_dir / "test.tsv").write_text("".join(test_rows))
+
+    return {
+        "users": num_users,
+        "items": num_items,
+        "train_interactions": len(train_rows),
+        "test_interactions": len(test_rows),
+        "entities": len(entities),
+    }
+
+
+def train_tiny_t5(output_dir, corpus_path, vocab_size=1000, seed=42):
+    """
+    Saves a randomly initialized tiny T5 with a sentencepiece tokenizer trained on the given corpus.
+    """
+    import sentencepiece as spm
+    import torch
+
+    from transformers import T5Config, T5ForConditionalGeneration, T5Tokenizer
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    spm.SentencePieceTrainer.train(
+        input=str(corpus_path), model_prefix=str(output_dir / "spiece"), vocab_size=vocab_size,
+        pad_id=0, eos_id=1, unk_id=2, bos_id=-1, model_type="unigram",
+        user_defined_symbols=LABEL_WORDS, minloglevel=2)
+    tokenizer = T5Tokenizer(str(output_dir / "spiece.model"), extra_ids=0)
+    tokenizer.save_pretrained(output_dir)
+
+    torch.manual_seed(seed)
+    config = T5Config(
+        vocab_size=len(tokenizer), d_model=64, d_ff=128, num_layers=2, num_heads=4, d_kv=16,
+        decoder_start_token_id=tokenizer.pad_token_id, pad_token_id=tokenizer.pad_token_id,
+        eos_token_id=tokenizer.eos_token_id)
+    T5ForConditionalGeneration(config).save_pretrained(output_dir)
+
+    return str(output_dir)
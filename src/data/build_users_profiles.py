@@ -1,46 +1,154 @@
+import argparse
+import json
+
 import pandas as pd
 
 from .paths import INTERIM_DATA_PATH, PROCESSED_DATA_PATH
 
-def main():
+SPLITS = ["train", "dev", "test"]
+PROFILES_PATH = INTERIM_DATA_PATH / "dbbook" / "users_profiles.json"
+
+
+def read_books_genres():
     books_genres = pd.read_csv(
-        INTERIM_DATA_PATH / "dbbook" / "item-prop" / "train.tsv", 
+        INTERIM_DATA_PATH / "dbbook" / "item-prop" / "train.tsv",
         sep="\t", header=None, names=['item_id', 'author', 'genre', 'series', 'publisher', 'subject'],
         dtype={'item_id': 'int64', 'author': 'str', 'genre': 'str', 'series': 'str', 'publisher': 'str', 'subject': 'str'})
-    books_genres = books_genres.drop(columns=["author", "series", "publisher", "subject"])
+    return books_genres.drop(columns=["author", "series", "publisher", "subject"])
 
-    books_ratings = pd.read_csv(INTERIM_DATA_PATH / "dbbook" / "train.tsv", sep="\t", header=None)
+
+def read_ratings(path):
+    books_ratings = pd.read_csv(path, sep="\t", header=None)
     books_ratings.columns = ["user_id", "item_id", "label"]
-    
-    positive_books_ratings = books_ratings.loc[books_ratings["label"] == 1]
-    positive_books_ratings = pd.merge(positive_books_ratings, books_genres, on="item_id", how="left")
-    positive_books_ratings.fillna("", inplace=True)
+    return books_ratings
+
+
+def liked_genres_rows(ratings, books_genres):
+    # positive interactions with a known genre, the first occurrence of each (user, genre) pair is kept
+    positive = ratings.loc[ratings["label"] == 1]
+    positive = pd.merge(positive, books_genres, on="item_id", how="left")
+    positive = positive.loc[positive["genre"].notna() & (positive["genre"] != "")]
+    return positive.drop_duplicates(subset=["user_id", "genre"])
+
+
+def build_split(split, liked_genres_by_user, books_genres):
+    split = split.merge(liked_genres_by_user, on="user_id", how="left")
+    split = pd.merge(split, books_genres, on="item_id", how="left")
+    split.fillna("", inplace=True)
+
+    return split.sort_values(by=["user_id", "item_id"], kind="stable")
+
+
+def write_split(split, split_name):
+    (PROCESSED_DATA_PATH / "dbbook").mkdir(parents=True, exist_ok=True)
+    split.to_csv(PROCESSED_DATA_PATH / "dbbook" / f"{split_name}.tsv", sep="\t", header=None, index=False)
+
+
+class UsersProfiles:
+    """
+    Liked genres of every user as interned genre ids, in order of first positive train interaction.
+    """
+    def __init__(self, genres=None, profiles=None):
+        self.genres = genres if genres is not None else []
+        self.genre_ids = {genre: genre_id for genre_id, genre in enumerate(self.genres)}
+        self.profiles = profiles if profiles is not None else {}
+
+    @classmethod
+    def build(cls, ratings, books_genres):
+        rows = liked_genres_rows(ratings, books_genres)
+        genre_ids, genres = pd.factorize(rows["genre"])
+        rows = rows.assign(genre_id=genre_ids)
 
-    liked_genres_by_user = positive_books_ratings.groupby("user_id")["genre"] \
-        .apply(list).reset_index()
-    liked_genres_by_user.columns = ["user_id", "liked_genres"]
+        profiles = rows.groupby("user_id", sort=False)["genre_id"].agg(list)
+        return cls(genres=genres.tolist(), profiles=profiles.to_dict())
 
-    liked_genres_by_user["liked_genres"] = liked_genres_by_user["liked_genres"] \
-        .map(lambda x: [str(element) for element in x if element != ""])
-    
-    for split_name in ["train", "dev", "test"]:
-        split = pd.read_csv(INTERIM_DATA_PATH / "dbbook" / f"{split_name}.tsv", sep="\t", header=None)
-        split.columns = ["user_id", "item_id", "label"]
+    def update(self, ratings, books_genres):
+        # returns the users whose liked genres changed
+        changed = set()
+        rows = liked_genres_rows(ratings, books_genres)
+        for user_id, genre in zip(rows["user_id"].tolist(), rows["genre"].tolist()):
+            if genre not in self.genre_ids:
+                self.genre_ids[genre] = len(self.genres)
+                self.genres.append(genre)
 
-        split = split.merge(liked_genres_by_user, on="user_id", how="left")
-        split.fillna("", inplace=True)
+            profile = self.profiles.setdefault(user_id, [])
+            if self.genre_ids[genre] not in profile:
+                profile.append(self.genre_ids[genre])
+                changed.add(user_id)
+        return changed
 
-        split = pd.merge(split, books_genres, on="item_id", how="left")
-        split.fillna("", inplace=True)
+    def liked_genres(self, user_ids=None):
+        user_ids = self.profiles.keys() if user_ids is None else [u for u in user_ids if u in self.profiles]
+        return pd.DataFrame({
+            "user_id": list(user_ids),
+            "liked_genres": [", ".join(self.genres[g] for g in self.profiles[u]) for u in user_ids],
+        }, columns=["user_id", "liked_genres"]).astype({"user_id": "int64", "liked_genres": "str"})
 
-        split["liked_genres"] = split["liked_genres"].map(lambda x: list(set(x)))
-        split["liked_genres"] = split["liked_genres"].map(lambda x: (", ".join(x)))
+    def save(self, path=PROFILES_PATH):
+        with open(path, "w") as f:
+            json.dump({"genres": self.genres, "profiles": {str(u): p for u, p in self.profiles.items()}}, f)
 
-        split = split.sort_values(by=["user_id", "item_id"])
+    @classmethod
+    def load(cls, path=PROFILES_PATH):
+        with open(path) as f:
+            state = json.load(f)
+        return cls(genres=state["genres"], profiles={int(u): p for u, p in state["profiles"].items()})
 
-        (PROCESSED_DATA_PATH / "dbbook").mkdir(parents=True, exist_ok=True)
-        split.to_csv(PROCESSED_DATA_PATH / "dbbook" / f"{split_name}.tsv", sep="\t", header=None, index=False)
+
+def main():
+    books_genres = read_books_genres()
+
+    profiles = UsersProfiles.build(read_ratings(INTERIM_DATA_PATH / "dbbook" / "train.tsv"), books_genres)
+    liked_genres_by_user = profiles.liked_genres()
+
+    for split_name in SPLITS:
+        split = read_ratings(INTERIM_DATA_PATH / "dbbook" / f"{split_name}.tsv")
+        write_split(build_split(split, liked_genres_by_user, books_genres), split_name)
+
+    profiles.save()
+
+
+def update(delta_path):
+    """
+    Appends new train interactions and rewrites only the processed rows of the users they affect,
+    the result equals a full rebuild on the updated interim train set.
+    """
+    delta = read_ratings(delta_path)
+    delta.to_csv(INTERIM_DATA_PATH / "dbbook" / "train.tsv", sep="\t", header=False, index=False, mode="a")
+
+    # without a saved profile state there is nothing to update
+    if not PROFILES_PATH.exists():
+        return main()
+
+    books_genres = read_books_genres()
+    profiles = UsersProfiles.load()
+
+    # users with new liked genres change in every split, users with new rows change in train
+    affected = profiles.update(delta, books_genres) | set(delta["user_id"].tolist())
+    liked_genres_by_user = profiles.liked_genres(affected)
+
+    for split_name in SPLITS:
+        processed = pd.read_csv(
+            PROCESSED_DATA_PATH / "dbbook" / f"{split_name}.tsv", sep="\t", header=None,
+            names=["user_id", "item_id", "label", "liked_genres", "genre"],
+            dtype={"liked_genres": "str", "genre": "str"}, keep_default_na=False)
+
+        split = read_ratings(INTERIM_DATA_PATH / "dbbook" / f"{split_name}.tsv")
+        split = build_split(split.loc[split["user_id"].isin(affected)], liked_genres_by_user, books_genres)
+
+        processed = processed.loc[~processed["user_id"].isin(affected)]
+        processed = pd.concat([processed, split]).sort_values(by=["user_id", "item_id"], kind="stable")
+        write_split(processed, split_name)
+
+    profiles.save()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delta", help="TSV of new train interactions to apply incrementally")
+    args = parser.parse_args()
+
+    if args.delta is not None:
+        update(args.delta)
+    else:
+        main()
@@ -1,9 +1,13 @@
 import logging
+import numpy as np
 import torch
 
 from tqdm import tqdm
 
+from .feature_cache import FeatureCache, RaggedFeatures, fingerprint_files
 from .processors import processors_mapping
+from .templates import compile_template
+from ..utilities.profiling import profiler
 
 
 logger = logging.getLogger(__name__)
@@ -26,11 +30,20 @@ class PromptingDataset(torch.utils.data.Dataset):
         # Load examples
         logger.info("Loading examples for mode %s", mode)
 
-        self.query_examples = self.processor.get_examples(mode=mode)
+        self.features = self.load_cached_features(mode)
+        if self.features is not None:
+            self.query_examples = None
+            self.size = len(self.features)
+            return
+
+        with profiler.stage("data_loading"):
+            self.query_examples = self.processor.get_examples(mode=mode)
         self.size = len(self.query_examples)
 
         # If it is not training, we pre-process the data; otherwise, we process the data online.
-        if args.always_preprocess:
+        if args.feature_cache_dir is not None:
+            self.save_cached_features(mode)
+        elif args.always_preprocess:
             self.preprocess()
         else:
             if mode != "train":
@@ -82,22 +95,66 @@ class PromptingDataset(torch.utils.data.Dataset):
         return self.size
 
 
+    def feature_cache_key(self, cache, mode):
+        return cache.key(
+            dataset=type(self).__name__,
+            mode=mode,
+            template=self.args.template,
+            mapping=self.args.mapping,
+            pretokenize_template=self.args.pretokenize_template,
+            tokenizer=[type(self.tokenizer).__name__, self.tokenizer.name_or_path, len(self.tokenizer)],
+            input_files=fingerprint_files(self.processor.get_input_files(mode=mode)),
+        )
+
+
+    def load_cached_features(self, mode):
+        if self.args.feature_cache_dir is None:
+            return None
+
+        with profiler.stage("data_loading"):
+            cache = FeatureCache(self.args.feature_cache_dir)
+            return cache.load(self.feature_cache_key(cache, mode))
+
+
+    def save_cached_features(self, mode):
+        # tokenize every example once, the features are then memory-mapped from the cache
+        self.features = None
+        features = [self[i] for i in tqdm(range(self.size))]
+
+        cache = FeatureCache(self.args.feature_cache_dir)
+        self.features = cache.save(self.feature_cache_key(cache, mode), features)
+
+
+    @property
+    def compiled_template(self):
+        if not self.args.pretokenize_template:
+            return None
+
+        return compile_template(self.args.template, self.tokenizer)
+
+
     def get_labels(self):
         return self.label_list
 
+
+    def get_lengths(self):
+        # input lengths for length bucketing, examples processed online are tokenized once here
+        if isinstance(self.features, RaggedFeatures):
+            return self.features.get_lengths()
+
+        return np.array([len(self[i]["input_ids"]) for i in range(self.size)], dtype=np.int64)
+
 class TruncateDataset(PromptingDataset):
     def preprocess(self):
         self.texts = []
+        self.token_ids = []
 
         for example in tqdm(self.query_examples):
-            text = self.convert_fn(example)
-            self.texts.append(text)
+            input_ids = self.convert_fn(example)
+            self.token_ids.append((example['item_id'], input_ids))
+            self.texts.append((example['item_id'], self.tokenizer.decode(input_ids)))
 
 
     def convert_fn(self, example):
         max_length = self.args.max_seq_length
-        input_ids = self.tokenizer(example['text'], truncation=True, max_length=max_length, add_special_tokens=False).data['input_ids']
-
-        return self.tokenizer.decode(input_ids)
-
-
+        return self.tokenizer(example['text'], truncation=True, max_length=max_length, add_special_tokens=False).data['input_ids']
@@ -0,0 +1,92 @@
+import argparse
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from ..paths import ELLIOT_DATA_PATH, RESULTS_PATH
+
+logger = logging.getLogger(__name__)
+
+
+def read_test_user_ids(test_path):
+    test = pd.read_csv(
+        test_path,
+        sep='\t', header=None, usecols=[0],
+        names=['user_id'],
+        dtype={'user_id': int})
+
+    return test.user_id.unique()
+
+
+def export_predictions(results_path, output_path, test_user_ids, top_k=None):
+    # rankings may carry a score column, only user and item are exported
+    predictions = pd.read_csv(
+        results_path,
+        sep='\t', header=None, usecols=[0, 1],
+        names=['user_id', 'item_id'])
+
+    # drop users that are not in the elliot test set
+    predictions = predictions.loc[predictions.user_id.isin(test_user_ids), :]
+
+    # rankings are written best first, so the first k rows of a user are its top-k
+    if top_k is not None:
+        predictions = predictions.groupby('user_id', sort=False).head(top_k)
+
+    predictions.to_csv(output_path, sep='\t', header=False, index=False)
+
+    return output_path, len(predictions)
+
+
+def export_results_files(results_dir, results_files, test_path, top_k=None, workers=None):
+    """
+    Converts ranking results files to elliot recommendation files, one process per file.
+    """
+    results_dir = Path(results_dir)
+    test_user_ids = read_test_user_ids(test_path)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                export_predictions,
+                results_dir / results_file, results_dir / f'elliot-{results_file}',
+                test_user_ids, top_k)
+            for results_file in results_files
+        ]
+        for future in futures:
+            output_path, size = future.result()
+            logger.info("Exported %d predictions to %s", size, output_path)
+
+
+def list_results_files(results_dir):
+    return sorted(
+        file for file in os.listdir(results_dir)
+        if file.endswith('.txt') and not file.startswith('elliot-'))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--results-dir", default=str(RESULTS_PATH))
+    parser.add_argument("--test", default=str(ELLIOT_DATA_PATH / 'dbbook' / 'test.tsv'))
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("results_files", nargs="*", help="Defaults to every results file in the directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    export_results_files(
+        args.results_dir,
+        args.results_files or list_results_files(args.results_dir),
+        args.test, top_k=args.top_k, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
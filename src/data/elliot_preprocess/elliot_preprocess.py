@@ -1,13 +1,7 @@
 import pandas as pd
 
 from ..paths import RAW_DATA_PATH, ELLIOT_DATA_PATH
-
-def get_item_text(item_path):
-    try:
-        with open(item_path, 'r') as f:
-            return f.read()
-    except FileNotFoundError:
-        return ''
+from ..text_store import read_text_file
 
 def main():
     df = pd.read_csv(
@@ -16,8 +10,11 @@ def main():
         names=['user_id', 'item_id', 'label'])
     
     df = df.loc[df.label != 0, :]
-    df["item_text"] = df.item_id \
-        .map(lambda x: get_item_text(RAW_DATA_PATH / "dbbook" / "texts" / f"{str(x)}.text"))
+    item_texts = {
+        item_id: read_text_file(RAW_DATA_PATH / "dbbook" / "texts" / f"{item_id}.text")
+        for item_id in df.item_id.unique()
+    }
+    df["item_text"] = df.item_id.map(item_texts)
     
     df.fillna('', inplace=True)
     df = df.loc[df.item_text != '', :]
@@ -2,13 +2,6 @@ import pandas as pd
 
 from ..paths import RAW_DATA_PATH, INTERIM_DATA_PATH, ELLIOT_DATA_PATH
 
-def get_item_text(item_path):
-    try:
-        with open(item_path, 'r') as f:
-            return f.read()
-    except FileNotFoundError:
-        return ''
-
 def main():
     df = pd.read_csv(
         RAW_DATA_PATH / 'dbbook' / 'test.tsv', 
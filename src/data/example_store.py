@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+
+def encode_categorical(values):
+    # interned categories, one int32 code per example
+    codes, categories = pd.factorize(values, sort=False)
+    return codes.astype(np.int32), np.asarray(categories, dtype=object)
+
+
+class ExampleStore:
+    """
+    Columnar examples: integer columns as arrays, repeated strings as codes into interned categories
+    and item features stored once per item in a shared item table.
+    Indexing and iteration yield the example as a dict, as the list of records did.
+    """
+    def __init__(self, arrays, categoricals, item_columns, item_positions):
+        self.arrays = arrays
+        self.categoricals = categoricals
+        self.item_columns = item_columns
+        self.item_positions = item_positions
+
+    @classmethod
+    def from_frame(cls, df, categorical_columns=(), item_columns=()):
+        """
+        Builds the store from a frame of examples, item columns must only depend on item_id.
+        """
+        item_ids = df.item_id.to_numpy(dtype=np.int64)
+        unique_item_ids, first, item_positions = np.unique(item_ids, return_index=True, return_inverse=True)
+
+        arrays = {
+            name: df[name].to_numpy(dtype=np.int64)
+            for name in df.columns if name not in categorical_columns and name not in item_columns
+        }
+        categoricals = {name: encode_categorical(df[name].to_numpy()) for name in categorical_columns}
+        item_table = {name: df[name].to_numpy()[first] for name in item_columns}
+
+        return cls(arrays, categoricals, item_table, item_positions.astype(np.int32))
+
+    def column(self, name):
+        if name in self.arrays:
+            return self.arrays[name]
+        if name in self.categoricals:
+            codes, categories = self.categoricals[name]
+            return categories[codes]
+        return self.item_columns[name][self.item_positions]
+
+    def take(self, indices):
+        """
+        Examples at the given positions, the categories and the item table are shared, not copied.
+        """
+        return ExampleStore(
+            {name: values[indices] for name, values in self.arrays.items()},
+            {name: (codes[indices], categories) for name, (codes, categories) in self.categoricals.items()},
+            self.item_columns,
+            self.item_positions[indices])
+
+    def pairs(self):
+        return list(zip(self.arrays['user_id'].tolist(), self.arrays['item_id'].tolist()))
+
+    def __len__(self):
+        return len(self.item_positions)
+
+    def __getitem__(self, i):
+        example = {name: values[i].item() for name, values in self.arrays.items()}
+        for name, (codes, categories) in self.categoricals.items():
+            example[name] = categories[codes[i]]
+        position = self.item_positions[i]
+        for name, values in self.item_columns.items():
+            example[name] = values[position]
+
+        return example
+
+    def __iter__(self):
+        names = [*self.arrays, *self.categoricals, *self.item_columns]
+        columns = [self.arrays[name].tolist() for name in self.arrays]
+        columns += [self.column(name).tolist() for name in [*self.categoricals, *self.item_columns]]
+        for values in zip(*columns):
+            yield dict(zip(names, values))
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RAGGED_KEYS = ['input_ids', 'labels']
+SCALAR_KEYS = ['user_id', 'item_id']
+
+
+def fingerprint_files(paths):
+    fingerprints = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprints.append([str(path), stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            fingerprints.append([str(path), None, None])
+    return fingerprints
+
+
+class RaggedFeatures:
+    """
+    Tokenized features kept as flat int32 buffers plus offsets, indexable like a list of feature dicts.
+    """
+    def __init__(self, buffers, offsets, scalars):
+        self.buffers = buffers
+        self.offsets = offsets
+        self.scalars = scalars
+        self.size = len(next(iter(offsets.values()))) - 1
+
+    @classmethod
+    def from_features(cls, features):
+        buffers, offsets, scalars = {}, {}, {}
+        for key in RAGGED_KEYS:
+            if len(features) > 0 and key in features[0]:
+                values = [np.asarray(feature[key], dtype=np.int32).reshape(-1) for feature in features]
+                lengths = np.array([len(value) for value in values], dtype=np.int64)
+                offsets[key] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+                buffers[key] = np.concatenate(values) if values else np.zeros(0, dtype=np.int32)
+        for key in SCALAR_KEYS:
+            if len(features) > 0 and key in features[0]:
+                scalars[key] = np.array([int(feature[key]) for feature in features], dtype=np.int64)
+
+        if not offsets:
+            offsets['input_ids'] = np.zeros(1, dtype=np.int64)
+            buffers['input_ids'] = np.zeros(0, dtype=np.int32)
+
+        return cls(buffers, offsets, scalars)
+
+    def __getitem__(self, i):
+        feature = {}
+        for key, buffer in self.buffers.items():
+            feature[key] = buffer[self.offsets[key][i]:self.offsets[key][i + 1]].tolist()
+        # features are never padded before collation
+        feature['attention_mask'] = [1] * len(feature['input_ids'])
+        for key, values in self.scalars.items():
+            feature[key] = int(values[i])
+        return feature
+
+    def __len__(self):
+        return self.size
+
+    def get_lengths(self):
+        return np.diff(self.offsets['input_ids'])
+
+    def save(self, path):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for key, buffer in self.buffers.items():
+            np.save(path / f"{key}.npy", buffer)
+            np.save(path / f"{key}.offsets.npy", self.offsets[key])
+        for key, values in self.scalars.items():
+            np.save(path / f"{key}.npy", values)
+
+        with open(path / "meta.json", "w") as f:
+            json.dump({"ragged": list(self.buffers.keys()), "scalars": list(self.scalars.keys())}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        path = Path(path)
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+
+        buffers = {key: np.load(path / f"{key}.npy", mmap_mode=mmap_mode) for key in meta["ragged"]}
+        offsets = {key: np.load(path / f"{key}.offsets.npy") for key in meta["ragged"]}
+        scalars = {key: np.load(path / f"{key}.npy", mmap_mode=mmap_mode) for key in meta["scalars"]}
+
+        return cls(buffers, offsets, scalars)
+
+
+class FeatureCache:
+    """
+    Directory of tokenized datasets, one entry per hash of template, mapping, tokenizer and input files.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+
+    def key(self, **fields):
+        return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def load(self, key):
+        path = self.cache_dir / key
+        if not (path / "meta.json").exists():
+            return None
+
+        logger.info("Loading tokenized features from %s", path)
+        return RaggedFeatures.load(path)
+
+    def save(self, key, features):
+        path = self.cache_dir / key
+        tmp_path = self.cache_dir / f"{key}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+        RaggedFeatures.from_features(features).save(tmp_path)
+
+        # another process may have written the same entry meanwhile
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        logger.info("Saved tokenized features to %s", path)
+
+        return RaggedFeatures.load(path)
@@ -1,51 +1,68 @@
 import os
+import numpy as np
 import pandas as pd
 
 from pathlib import Path
 
-from .paths import INTERIM_DATA_PATH, PROCESSED_DATA_PATH
+from .example_store import ExampleStore
+from .paths import RAW_DATA_PATH, INTERIM_DATA_PATH, PROCESSED_DATA_PATH
+from .text_store import get_store_files, open_text_store, read_text_file
 
-
-def get_item_text(item_path):
-    try:
-        with open(item_path, 'r') as f:
-            return f.read()
-    except FileNotFoundError:
-        return ''
+STRUCTURED_ITEM_COLUMNS = ['item_author', 'item_series', 'item_publisher', 'item_subject']
 
 class TruncateProcessor:
     def __init__(self, task_name):
         self.task_name = task_name
 
-    def get_examples(self, data_dir, mode=None):
+    def get_examples(self, data_dir=RAW_DATA_PATH / 'dbbook', mode=None):
         files = os.listdir(Path(data_dir) / 'texts')
         files = [Path(data_dir) / 'texts' / file for file in files]
-        texts = [f"{file.name.split('.')[0]};;{get_item_text(file)}" for file in files]
+        texts = [(int(file.name.split('.')[0]), read_text_file(file)) for file in files]
         return self._create_examples(texts)
 
     def get_labels(self):
         return ['0', '1']
 
     def _create_examples(self, lines):
-        return [{'text': line} for line in lines]
+        return [{'item_id': item_id, 'text': text} for item_id, text in lines]
 
 
 class DbbookProcessor:
     def __init__(self, task_name):
         self.task_name = task_name
+        # examples are read once per process and shared by every params file of a sweep
+        self.examples = {}
+
+    def get_input_files(self, mode='train'):
+        return [
+            PROCESSED_DATA_PATH / 'dbbook' / f"{mode}.tsv",
+            INTERIM_DATA_PATH / "dbbook" / "item-prop" / "train.tsv",
+            *get_store_files(PROCESSED_DATA_PATH / "dbbook"),
+        ]
 
     def get_examples(self, mode='train'):
+        if (False, mode) not in self.examples:
+            self.examples[(False, mode)] = self._load_examples(mode)
+
+        return self.examples[(False, mode)]
+
+    def get_structured_examples(self, mode='train'):
+        if (True, mode) not in self.examples:
+            self.examples[(True, mode)] = self._load_structured_examples(mode)
+
+        return self.examples[(True, mode)]
+
+    def _load_examples(self, mode):
         df = pd.read_csv(
             PROCESSED_DATA_PATH / 'dbbook' / f"{mode}.tsv", sep='\t', header=None, 
             names=['user_id', 'item_id', 'label', 'user_genres', 'item_genre'])
-        df["item_text"] = df.item_id \
-            .map(lambda x: get_item_text(PROCESSED_DATA_PATH / "dbbook" / "texts" / f"{str(x)}.text"))
+        df["item_text"] = open_text_store(PROCESSED_DATA_PATH / "dbbook").get_texts(df.item_id)
         df.fillna('', inplace=True)
         df = df.loc[df.item_text != '', :]
         
-        return df.to_dict(orient='records')
+        return ExampleStore.from_frame(df, categorical_columns=['user_genres', 'item_genre'], item_columns=['item_text'])
     
-    def get_structured_examples(self, mode='train'):
+    def _load_structured_examples(self, mode):
         df = pd.read_csv(PROCESSED_DATA_PATH / "dbbook" / f"{mode}.tsv", sep='\t', header=None, 
             names=['user_id', 'item_id', 'label', 'user_genres', 'item_genre'])
         
@@ -67,40 +84,101 @@ class DbbookProcessor:
         df = df.loc[df.item_publisher != '', :]
         df = df.loc[df.item_subject != '', :]
 
-        return df.to_dict(orient='records')
+        return ExampleStore.from_frame(
+            df, categorical_columns=['user_genres', 'item_genre'], item_columns=STRUCTURED_ITEM_COLUMNS)
 
     def get_labels(self):
         return [0, 1]
     
+class RankingCandidateIndex:
+    """
+    Ranking candidates grouped by user, built once and looked up in O(1).
+    """
+    def __init__(self, examples):
+        # users in order of first appearance, the examples of a user are contiguous
+        codes, user_ids = pd.factorize(examples.arrays['user_id'], sort=False)
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(user_ids))
+        ends = np.cumsum(counts)
+
+        self.examples = examples.take(order)
+        self.user_ids = user_ids.tolist()
+        self.ranges = dict(zip(self.user_ids, zip((ends - counts).tolist(), ends.tolist())))
+
+    def get_candidates(self, user_id):
+        start, end = self.ranges.get(user_id, (0, 0))
+        return self.examples.take(np.arange(start, end))
+
+    def get_users_candidates(self, user_ids):
+        # only the ranges of the given users are read, not the candidates of every user
+        ranges = [self.ranges.get(user_id, (0, 0)) for user_id in user_ids]
+        return self.examples.take(np.concatenate([np.arange(start, end) for start, end in ranges] + [np.empty(0, dtype=np.int64)]))
+
+    def get_all_candidates(self):
+        return self.examples
+
+    def get_user_ids(self):
+        return list(self.user_ids)
+
+    def __len__(self):
+        return len(self.examples)
+
+
 class DbbookRankingProcessor:
     def __init__(self, task_name):
         self.task_name = task_name
+        self.indexes = {}
 
-    def get_examples(self, user_id):
+    def get_input_files(self, mode='test'):
+        return [
+            PROCESSED_DATA_PATH / "dbbook" / "test.tsv",
+            INTERIM_DATA_PATH / "dbbook" / "item-prop" / "train.tsv",
+            *get_store_files(PROCESSED_DATA_PATH / "dbbook"),
+        ]
+
+    def get_index(self, structured=False):
+        if structured not in self.indexes:
+            examples = self._load_structured_examples() if structured else self._load_examples()
+            self.indexes[structured] = RankingCandidateIndex(examples)
+
+        return self.indexes[structured]
+
+    def get_examples(self, user_id=None, user_ids=None):
+        return self._select(self.get_index(structured=False), user_id, user_ids)
+
+    def get_structured_examples(self, user_id=None, user_ids=None):
+        return self._select(self.get_index(structured=True), user_id, user_ids)
+
+    def _select(self, index, user_id, user_ids):
+        if user_id is not None:
+            return index.get_candidates(user_id)
+        if user_ids is not None:
+            return index.get_users_candidates(user_ids)
+
+        return index.get_all_candidates()
+
+    def _load_examples(self):
         df = pd.read_csv(
             PROCESSED_DATA_PATH / "dbbook" / "test.tsv", sep='\t', header=None, 
             names=['user_id', 'item_id', 'label', 'user_genres', 'item_genre'])
 
-        df = df.loc[df.user_id == user_id]
         df.fillna('', inplace=True)
-        df["item_text"] = df.item_id \
-            .map(lambda x: get_item_text(PROCESSED_DATA_PATH / "dbbook" / "texts" / (str(x) + ".text")))
-        
+
+        df["item_text"] = open_text_store(PROCESSED_DATA_PATH / "dbbook").get_texts(df.item_id)
+
         df.drop(['label', 'item_genre'], axis=1, inplace=True)
         df = df.loc[df.item_text != '', :]
-        
-        return df.to_dict(orient='records')
-    
-    def get_structured_examples(self, user_id):
-        df = pd.read_csv(PROCESSED_DATA_PATH / "dbbook" / f"test.tsv", sep='\t', header=None, 
+
+        return ExampleStore.from_frame(df, categorical_columns=['user_genres'], item_columns=['item_text'])
+
+    def _load_structured_examples(self):
+        df = pd.read_csv(PROCESSED_DATA_PATH / "dbbook" / "test.tsv", sep='\t', header=None, 
             names=['user_id', 'item_id', 'label', 'user_genres', 'item_genre'])
         
         item_features = pd.read_csv(
             INTERIM_DATA_PATH / "dbbook" / "item-prop" / "train.tsv", sep='\t', header=None,
             names=['item_id', 'item_author', 'item_genre', 'item_series', 'item_publisher', 'item_subject'])
 
-        df = df.loc[df.user_id == user_id]
-
         # merge df with item features
         df = df.merge(item_features, on='item_id', how='left')
         df.fillna('', inplace=True)
@@ -117,7 +195,8 @@ class DbbookRankingProcessor:
 
         df.drop(['label'], axis=1, inplace=True)
 
-        return df.to_dict(orient='records')        
+        return ExampleStore.from_frame(
+            df, categorical_columns=['user_genres', 'item_genre'], item_columns=STRUCTURED_ITEM_COLUMNS)
 
     def get_labels(self):
         return [0, 1]
@@ -0,0 +1,119 @@
+import logging
+import math
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def count_padding(lengths, batches):
+    tokens = int(sum(lengths[batch].sum() for batch in batches))
+    padded = int(sum(lengths[batch].max() * len(batch) for batch in batches if len(batch) > 0))
+    return tokens, padded
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches examples of similar length together, so collated batches carry less padding.
+
+    Examples are shuffled, split in windows of bucket_size batches and sorted by length inside each window.
+    With max_tokens set, batches are filled up to a padded token budget instead of a fixed batch size.
+    """
+    def __init__(self, lengths, batch_size, max_tokens=None, shuffle=True, bucket_size=100, seed=42, drop_last=False):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.epoch_batches = None
+
+    def set_epoch(self, epoch):
+        # the trainer sets the epoch before every pass, so the order only depends on the seed and the epoch
+        self.epoch = epoch
+
+    def _split(self, indices):
+        if self.max_tokens is None:
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+        batches, start, longest = [], 0, 0
+        for end, length in enumerate(self.lengths[indices]):
+            longest = max(longest, length)
+            # padded cost of the batch if this example is added, a batch always holds one example
+            if end > start and longest * (end - start + 1) > self.max_tokens:
+                batches.append(indices[start:end])
+                start, longest = end, length
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
+
+    def get_batches(self, epoch=None):
+        if epoch is None:
+            # built once per epoch, so len() and iteration agree on the batches
+            if self.epoch_batches is None or self.epoch_batches[0] != self.epoch:
+                self.epoch_batches = (self.epoch, self.build_batches(self.epoch))
+            return self.epoch_batches[1]
+
+        return self.build_batches(epoch)
+
+    def build_batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+
+        if self.shuffle:
+            indices = rng.permutation(len(self.lengths))
+            window = self.batch_size * self.bucket_size
+        else:
+            indices = np.arange(len(self.lengths))
+            window = len(indices)
+
+        batches = []
+        for start in range(0, len(indices), max(window, 1)):
+            bucket = indices[start:start + window]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(self._split(bucket))
+
+        if self.drop_last and self.max_tokens is None and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        return batches
+
+    def __iter__(self):
+        for batch in self.get_batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.max_tokens is None:
+            if self.drop_last:
+                return len(self.lengths) // self.batch_size
+            return math.ceil(len(self.lengths) / self.batch_size)
+        return len(self.get_batches())
+
+    def padding_stats(self):
+        batches = self.get_batches()
+        tokens, padded = count_padding(self.lengths, batches)
+
+        # same number of batches drawn without bucketing
+        indices = np.random.default_rng(self.seed).permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        unbucketed = np.array_split(indices, max(len(batches), 1))
+        _, unbucketed_padded = count_padding(self.lengths, unbucketed)
+
+        return {
+            "tokens": tokens,
+            "padded_tokens": padded,
+            "unbucketed_padded_tokens": unbucketed_padded,
+            "pad_ratio": 1 - tokens / max(padded, 1),
+            "unbucketed_pad_ratio": 1 - tokens / max(unbucketed_padded, 1),
+            "removed_pad_tokens": unbucketed_padded - padded,
+        }
+
+    def log_padding_stats(self, name):
+        stats = self.padding_stats()
+        logger.info(
+            "Length bucketing (%s): pad ratio %.1f%% -> %.1f%%, %d pad tokens removed",
+            name, 100 * stats["unbucketed_pad_ratio"], 100 * stats["pad_ratio"], stats["removed_pad_tokens"])
+        return stats
@@ -1,33 +1,83 @@
 import logging
 import random
 
+import numpy as np
+
 from .dataset import PromptingDataset
-from .processors import DbbookProcessor, DbbookRankingProcessor
+from .processors import processors_mapping
+from ..utilities.profiling import profiler
 
 logger = logging.getLogger(__name__)
 
+# slots only filled by the item properties of the structured examples
+STRUCTURED_SLOTS = ['*item_author*', '*item_series*', '*item_publisher*', '*item_subject*']
+
 def tokenize_multipart_input(
     example,
     tokenizer,
     template=None,
     return_tensors=None,
+    compiled_template=None,
 ):
     assert template is not None
 
-    template = template.replace('*user_id*', str(example['user_id']))
-    template = template.replace('*item_id*', str(example['item_id']))
-    template = template.replace('*item_text*', example['item_text'])
+    if compiled_template is not None:
+        with profiler.stage("tokenization"):
+            return compiled_template.encode(example, return_tensors=return_tensors)
+
+    with profiler.stage("template_rendering"):
+        template = template.replace('*user_id*', str(example['user_id']))
+        template = template.replace('*item_id*', str(example['item_id']))
+        template = template.replace('*item_text*', example['item_text'])
+
+        if (example['user_genres'] != ''):
+            template = template.replace('*user_genres*', example['user_genres'])
+        else:
+            template = template.replace(
+                'User likes the book genres *user_genres*', 
+                'We don\'t know which genres the user likes')
 
-    if (example['user_genres'] != ''):
-        template = template.replace('*user_genres*', example['user_genres'])
-    else:
-        template = template.replace(
-            'User likes the book genres *user_genres*', 
-            'We don\'t know which genres the user likes')
-    if return_tensors is not None:
-        return tokenizer(template, return_tensors=return_tensors).data
+    with profiler.stage("tokenization"):
+        if return_tensors is not None:
+            return tokenizer(template, return_tensors=return_tensors).data
 
-    return tokenizer(template).data
+        return tokenizer(template).data
+
+
+def tokenize_structured_input(
+    example,
+    tokenizer,
+    template=None,
+    return_tensors=None,
+    compiled_template=None,
+):
+    assert template is not None
+
+    if compiled_template is not None:
+        with profiler.stage("tokenization"):
+            return compiled_template.encode(example, return_tensors=return_tensors)
+
+    with profiler.stage("template_rendering"):
+        template = template.replace('*user_id*', str(example['user_id']))
+        template = template.replace('*item_id*', str(example['item_id']))
+        template = template.replace('*item_genre*', example['item_genre'])
+        template = template.replace('*item_author*', example['item_author'])
+        template = template.replace('*item_series*', example['item_series'])
+        template = template.replace('*item_publisher*', example['item_publisher'])
+        template = template.replace('*item_subject*', example['item_subject'])
+
+        if (example['user_genres'] != ''):
+            template = template.replace('*user_genres*', example['user_genres'])
+        else:
+            template = template.replace(
+                'User likes the book genres *user_genres*', 
+                'We don\'t know which genres the user likes')
+
+    with profiler.stage("tokenization"):
+        if return_tensors is not None:
+            return tokenizer(template, return_tensors=return_tensors).data
+
+        return tokenizer(template).data
 
 
 class T5PromptingDataset(PromptingDataset):
@@ -41,6 +91,7 @@ class T5PromptingDataset(PromptingDataset):
             example=example,
             tokenizer=self.tokenizer,
             template=template,
+            compiled_template=self.compiled_template,
         )
 
         inputs["labels"] = self.tokenizer(f"{self.label_to_word[example['label']]}").input_ids
@@ -53,18 +104,37 @@ class T5PromptingDataset(PromptingDataset):
 
 
 class T5EvalAsRankDataset(PromptingDataset):
-    def __init__(self, args, tokenizer, user_id=None):
+    def __init__(self, args, tokenizer, user_id=None, candidates=None, user_ids=None):
         self.args = args
         self.task_name = args.task_name
-        self.processor = DbbookRankingProcessor("dbbook_ranking")
+        # shared processor, so the candidate index is built once for all users
+        self.processor = processors_mapping["dbbook_ranking"]
         self.tokenizer = tokenizer
 
-        self.query_examples = self.processor.get_examples(user_id=user_id)
+        # only the unfiltered dataset of all users is cached, per-user datasets are cheap to tokenize
+        cached = user_id is None and user_ids is None and candidates is None
+        self.features = self.load_cached_features("ranking") if cached else None
+        if self.features is not None:
+            self.query_examples = None
+            self.size = len(self.features)
+            return
+
+        with profiler.stage("data_loading"):
+            self.query_examples = self.processor.get_examples(user_id=user_id, user_ids=user_ids)
+        # (user_id, item_id) pairs kept by a cascade prefilter, only checked for the selected users
+        if candidates is not None:
+            keep = [pair in candidates for pair in self.query_examples.pairs()]
+            self.query_examples = self.query_examples.take(np.flatnonzero(keep))
         self.size = len(self.query_examples)
 
         self.features = None
+        if cached and args.feature_cache_dir is not None:
+            self.save_cached_features("ranking")
 
     def __getitem__(self, i):
+        if self.features is not None:
+            return self.features[i]
+
         example = self.query_examples[i]
 
         template = self.args.template
@@ -75,6 +145,7 @@ class T5EvalAsRankDataset(PromptingDataset):
             verbose=False,
         )
 
+        features["user_id"] = example["user_id"]
         features["item_id"] = example["item_id"]
 
         return features
@@ -89,7 +160,8 @@ class T5EvalAsRankDataset(PromptingDataset):
             example=example,
             tokenizer=self.tokenizer,
             template=template,
-            return_tensors='pt'
+            return_tensors='pt',
+            compiled_template=self.compiled_template,
         )
 
         inputs["input_ids"] = inputs["input_ids"].squeeze()
@@ -106,7 +178,7 @@ class T5PromptingStructuredDataset(PromptingDataset):
     def __init__(self, args, tokenizer, mode="train"):
         self.args = args
         self.task_name = args.task_name
-        self.processor = DbbookProcessor(args.task_name)
+        self.processor = processors_mapping[args.task_name]
         self.tokenizer = tokenizer
 
         assert mode in ["train", "dev", "test"]
@@ -120,49 +192,35 @@ class T5PromptingStructuredDataset(PromptingDataset):
         # Load examples
         logger.info("Loading examples for mode %s", mode)
 
-        self.query_examples = self.processor.get_structured_examples(mode=mode)
+        self.features = self.load_cached_features(mode)
+        if self.features is not None:
+            self.query_examples = None
+            self.size = len(self.features)
+            return
+
+        with profiler.stage("data_loading"):
+            self.query_examples = self.processor.get_structured_examples(mode=mode)
         self.size = len(self.query_examples)
 
-        if mode == 'dev':
+        if args.feature_cache_dir is not None:
+            self.save_cached_features(mode)
+        elif mode == 'dev':
             self.preprocess()
         else:
             self.features = None
 
 
-    def tokenize_multipart_input(
-        self,
-        example,
-        template=None
-    ):
-        assert template is not None
-
-        template = template.replace('*user_id*', str(example['user_id']))
-        template = template.replace('*item_id*', str(example['item_id']))
-        template = template.replace('*item_genre*', example['item_genre'])
-        template = template.replace('*item_author*', example['item_author'])
-        template = template.replace('*item_series*', example['item_series'])
-        template = template.replace('*item_publisher*', example['item_publisher'])
-        template = template.replace('*item_subject*', example['item_subject'])
-
-        if (example['user_genres'] != ''):
-            template = template.replace('*user_genres*', example['user_genres'])
-        else:
-            template = template.replace(
-                'User likes the book genres *user_genres*', 
-                'We don\'t know which genres the user likes')
-        
-        return self.tokenizer(template).data
-
-
     def convert_fn(
         self,
         example,
         template=None,
         verbose=False
     ):
-        inputs = self.tokenize_multipart_input(
+        inputs = tokenize_structured_input(
             example=example,
+            tokenizer=self.tokenizer,
             template=template,
+            compiled_template=self.compiled_template,
         )
 
         inputs["labels"] = self.tokenizer(f"{self.label_to_word[example['label']]}").input_ids
@@ -175,19 +233,38 @@ class T5PromptingStructuredDataset(PromptingDataset):
 
 
 class T5EvalAsRankStructuredDataset(PromptingDataset):
-    def __init__(self, args, tokenizer, user_id=None):
+    def __init__(self, args, tokenizer, user_id=None, candidates=None, user_ids=None):
         self.args = args
         self.task_name = args.task_name
-        self.processor = DbbookRankingProcessor("dbbook_ranking")
+        # shared processor, so the candidate index is built once for all users
+        self.processor = processors_mapping["dbbook_ranking"]
         self.tokenizer = tokenizer
 
-        self.query_examples = self.processor.get_structured_examples(user_id=user_id)
+        # only the unfiltered dataset of all users is cached, per-user datasets are cheap to tokenize
+        cached = user_id is None and user_ids is None and candidates is None
+        self.features = self.load_cached_features("ranking") if cached else None
+        if self.features is not None:
+            self.query_examples = None
+            self.size = len(self.features)
+            return
+
+        with profiler.stage("data_loading"):
+            self.query_examples = self.processor.get_structured_examples(user_id=user_id, user_ids=user_ids)
+        # (user_id, item_id) pairs kept by a cascade prefilter, only checked for the selected users
+        if candidates is not None:
+            keep = [pair in candidates for pair in self.query_examples.pairs()]
+            self.query_examples = self.query_examples.take(np.flatnonzero(keep))
         self.size = len(self.query_examples)
 
         self.features = None
+        if cached and args.feature_cache_dir is not None:
+            self.save_cached_features("ranking")
 
 
     def __getitem__(self, i):
+        if self.features is not None:
+            return self.features[i]
+
         example = self.query_examples[i]
 
         template = self.args.template
@@ -198,45 +275,24 @@ class T5EvalAsRankStructuredDataset(PromptingDataset):
             verbose=False,
         )
 
+        features["user_id"] = example["user_id"]
         features["item_id"] = example["item_id"]
 
         return features
 
 
-    def tokenize_multipart_input(
-        self,
-        example,
-        template=None
-    ):
-        assert template is not None
-
-        template = template.replace('*user_id*', str(example['user_id']))
-        template = template.replace('*item_id*', str(example['item_id']))
-        template = template.replace('*item_genre*', example['item_genre'])
-        template = template.replace('*item_author*', example['item_author'])
-        template = template.replace('*item_series*', example['item_series'])
-        template = template.replace('*item_publisher*', example['item_publisher'])
-        template = template.replace('*item_subject*', example['item_subject'])
-
-        if (example['user_genres'] != ''):
-            template = template.replace('*user_genres*', example['user_genres'])
-        else:
-            template = template.replace(
-                'User likes the book genres *user_genres*', 
-                'We don\'t know which genres the user likes')
-        
-        return self.tokenizer(template, return_tensors='pt').data
-
-
     def convert_fn(
         self,
         example,
         template=None,
         verbose=False
     ):
-        inputs = self.tokenize_multipart_input(
+        inputs = tokenize_structured_input(
             example=example,
+            tokenizer=self.tokenizer,
             template=template,
+            return_tensors='pt',
+            compiled_template=self.compiled_template,
         )
 
         inputs["input_ids"] = inputs["input_ids"].squeeze()
@@ -246,4 +302,16 @@ class T5EvalAsRankStructuredDataset(PromptingDataset):
             logger.info("*** Example ***")
             logger.info("text: %s" % self.tokenizer.decode(inputs["input_ids"].squeeze().tolist()))
 
-        return inputs, None
\ No newline at end of file
+        return inputs, None
+
+def is_structured_template(template):
+    return any(slot in template for slot in STRUCTURED_SLOTS)
+
+
+def get_prompting_dataset_class(template):
+    # structured templates need the item properties, the others the item texts
+    return T5PromptingStructuredDataset if is_structured_template(template) else T5PromptingDataset
+
+
+def get_ranking_dataset_class(template):
+    return T5EvalAsRankStructuredDataset if is_structured_template(template) else T5EvalAsRankDataset
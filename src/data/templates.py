@@ -0,0 +1,120 @@
+import re
+
+from functools import lru_cache
+
+import torch
+
+from .paths import PROCESSED_DATA_PATH
+from .text_store import open_token_store
+
+SPIECE_UNDERLINE = "▁"
+
+SLOT_PATTERN = re.compile(r'(\*\w+\*)')
+
+NO_USER_GENRES = (
+    'User likes the book genres *user_genres*',
+    'We don\'t know which genres the user likes')
+
+
+class SegmentTokenCache:
+    """
+    Token ids of template segments and field values, computed once per distinct string.
+    """
+    def __init__(self, tokenizer, token_store=None):
+        self.tokenizer = tokenizer
+        # item texts tokenized by truncate_texts, only usable with the same tokenizer
+        self.token_store = token_store if token_store is not None and token_store.matches(tokenizer) else None
+        # sentencepiece prefixes every separately tokenized segment with a word boundary
+        prefix_id = tokenizer.convert_tokens_to_ids(SPIECE_UNDERLINE)
+        self.prefix_id = prefix_id if prefix_id != tokenizer.unk_token_id else None
+        self.texts = {}
+        self.item_texts = {}
+
+    def _attach(self, token_ids, attached):
+        # a segment glued to the previous one (e.g. ". User" after a slot) must not start a new word
+        if attached and token_ids and token_ids[0] == self.prefix_id:
+            return token_ids[1:]
+        return token_ids
+
+    def get(self, text, attached=False):
+        token_ids = self.texts.get((text, attached))
+        if token_ids is None:
+            token_ids = self.tokenizer(text, add_special_tokens=False).input_ids
+            token_ids = self.texts[(text, attached)] = self._attach(token_ids, attached)
+        return token_ids
+
+    def get_item_text(self, item_id, text, attached=False):
+        token_ids = self.item_texts.get((item_id, attached))
+        if token_ids is None:
+            stored = self.token_store.get_token_ids(item_id) if self.token_store is not None else None
+            if stored is not None:
+                token_ids = self._attach(stored.tolist(), attached)
+            else:
+                token_ids = self.get(text, attached)
+            self.item_texts[(item_id, attached)] = token_ids
+        return token_ids
+
+
+class CompiledTemplate:
+    """
+    Template split once into literal and slot segments, each prompt is assembled by concatenating
+    cached token ids instead of rendering and tokenizing the whole string.
+
+    Segments are tokenized on their own, so the ids at a segment boundary may differ from the ones of
+    the rendered prompt: a model has to be trained and evaluated with the same setting.
+    """
+    def __init__(self, template, token_cache):
+        self.token_cache = token_cache
+        self.segments = self._compile(template)
+        # same fallback as the string replace path when the user has no liked genres
+        self.no_user_genres_segments = self._compile(template.replace(*NO_USER_GENRES), literal_slots=('user_genres',))
+
+    def _compile(self, template, literal_slots=()):
+        segments = []
+        previous = ''
+        for part in SLOT_PATTERN.split(template):
+            if part == '':
+                continue
+
+            if SLOT_PATTERN.fullmatch(part) and part[1:-1] not in literal_slots:
+                attached = previous != '' and not previous[-1].isspace()
+                segments.append((part[1:-1], attached, None))
+            else:
+                attached = previous != '' and not part[0].isspace()
+                segments.append((None, attached, self.token_cache.get(part, attached)))
+            previous = part
+        return segments
+
+    def encode(self, example, return_tensors=None):
+        segments = self.segments if example['user_genres'] != '' else self.no_user_genres_segments
+
+        input_ids = []
+        for field, attached, token_ids in segments:
+            if field is None:
+                input_ids.extend(token_ids)
+            elif field not in example:
+                # unknown slots are left in the prompt as they are
+                input_ids.extend(self.token_cache.get(f"*{field}*", attached))
+            elif field == 'item_text':
+                input_ids.extend(self.token_cache.get_item_text(example['item_id'], example['item_text'], attached))
+            else:
+                input_ids.extend(self.token_cache.get(str(example[field]), attached))
+
+        input_ids = self.token_cache.tokenizer.build_inputs_with_special_tokens(input_ids)
+        attention_mask = [1] * len(input_ids)
+
+        if return_tensors == 'pt':
+            return {'input_ids': torch.tensor([input_ids]), 'attention_mask': torch.tensor([attention_mask])}
+
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+
+@lru_cache(maxsize=None)
+def get_segment_token_cache(tokenizer):
+    return SegmentTokenCache(tokenizer, token_store=open_token_store(PROCESSED_DATA_PATH / "dbbook"))
+
+
+@lru_cache(maxsize=None)
+def compile_template(template, tokenizer):
+    # templates compiled with the same tokenizer share the field token ids
+    return CompiledTemplate(template, get_segment_token_cache(tokenizer))
@@ -0,0 +1,152 @@
+import json
+import mmap
+
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+TEXTS_BLOB = "texts.bin"
+TEXTS_INDEX = "texts.idx.npy"
+TOKENS_BUFFER = "tokens.npy"
+TOKENS_INDEX = "tokens.idx.npy"
+TOKENS_META = "tokens.json"
+
+
+def get_store_files(path):
+    path = Path(path)
+    return [path / name for name in [TEXTS_BLOB, TEXTS_INDEX, TOKENS_BUFFER, TOKENS_INDEX, TOKENS_META]]
+
+
+def read_text_file(item_path):
+    try:
+        with open(item_path, 'r') as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+
+def write_packed_texts(path, texts):
+    """
+    Packs (item_id, text) pairs in one utf-8 blob plus a sorted item_id -> (offset, length) index.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    index = []
+    offset = 0
+    with open(path / TEXTS_BLOB, "wb") as f:
+        for item_id, text in sorted(texts, key=lambda x: x[0]):
+            data = text.encode("utf-8")
+            f.write(data)
+            index.append((item_id, offset, len(data)))
+            offset += len(data)
+
+    np.save(path / TEXTS_INDEX, np.array(index, dtype=np.int64).reshape(-1, 3))
+
+
+class PackedTextStore:
+    """
+    Read-only view of the packed item texts, the blob is memory-mapped and decoded on lookup.
+    """
+    def __init__(self, path):
+        path = Path(path)
+        index = np.load(path / TEXTS_INDEX)
+        self.item_ids = index[:, 0]
+        self.offsets = index[:, 1]
+        self.lengths = index[:, 2]
+
+        with open(path / TEXTS_BLOB, "rb") as f:
+            # mmap can not map an empty file
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.lengths.sum() > 0 else b''
+        self.view = memoryview(self.blob)
+
+    def _positions(self, item_ids):
+        item_ids = np.asarray(item_ids, dtype=np.int64)
+        if len(self.item_ids) == 0:
+            return np.full(len(item_ids), -1)
+
+        positions = np.searchsorted(self.item_ids, item_ids).clip(max=len(self.item_ids) - 1)
+        return np.where(self.item_ids[positions] == item_ids, positions, -1)
+
+    def _decode(self, position):
+        if position < 0:
+            return ''
+        offset = self.offsets[position]
+        return str(self.view[offset:offset + self.lengths[position]], 'utf-8')
+
+    def get_text(self, item_id):
+        return self._decode(self._positions([item_id])[0])
+
+    def get_texts(self, item_ids):
+        # each distinct item is decoded once
+        positions = self._positions(item_ids)
+        unique_positions, inverse = np.unique(positions, return_inverse=True)
+        texts = [self._decode(position) for position in unique_positions]
+        return [texts[i] for i in inverse.reshape(-1)]
+
+    def __contains__(self, item_id):
+        return self._positions([item_id])[0] >= 0
+
+    def __len__(self):
+        return len(self.item_ids)
+
+
+def write_packed_token_ids(path, token_ids, tokenizer):
+    """
+    Packs (item_id, token ids) pairs in one int32 buffer plus a sorted item_id -> (offset, length) index.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    token_ids = sorted(token_ids, key=lambda x: x[0])
+    lengths = np.array([len(ids) for _, ids in token_ids], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    item_ids = np.array([item_id for item_id, _ in token_ids], dtype=np.int64)
+
+    buffer = np.fromiter((i for _, ids in token_ids for i in ids), dtype=np.int32, count=int(lengths.sum()))
+    np.save(path / TOKENS_BUFFER, buffer)
+    np.save(path / TOKENS_INDEX, np.stack([item_ids, offsets, lengths], axis=1).reshape(-1, 3))
+
+    with open(path / TOKENS_META, "w") as f:
+        json.dump({"tokenizer": tokenizer.name_or_path, "vocab_size": len(tokenizer)}, f)
+
+
+class PackedTokenStore:
+    """
+    Read-only view of the packed item text token ids, the buffer is memory-mapped.
+    """
+    def __init__(self, path):
+        path = Path(path)
+        index = np.load(path / TOKENS_INDEX)
+        self.item_ids = index[:, 0]
+        self.offsets = index[:, 1]
+        self.lengths = index[:, 2]
+        self.buffer = np.load(path / TOKENS_BUFFER, mmap_mode='r')
+
+        with open(path / TOKENS_META) as f:
+            self.meta = json.load(f)
+
+    def matches(self, tokenizer):
+        return self.meta == {"tokenizer": tokenizer.name_or_path, "vocab_size": len(tokenizer)}
+
+    def get_token_ids(self, item_id):
+        position = np.searchsorted(self.item_ids, item_id)
+        if position == len(self.item_ids) or self.item_ids[position] != item_id:
+            return None
+
+        offset = self.offsets[position]
+        return self.buffer[offset:offset + self.lengths[position]]
+
+
+@lru_cache(maxsize=None)
+def open_text_store(path):
+    return PackedTextStore(path)
+
+
+@lru_cache(maxsize=None)
+def open_token_store(path):
+    path = Path(path)
+    if not (path / TOKENS_INDEX).exists():
+        return None
+    return PackedTokenStore(path)
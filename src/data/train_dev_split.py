@@ -3,26 +3,70 @@ import yaml
 
 from .paths import RAW_DATA_PATH, INTERIM_DATA_PATH
 
+COLUMNS = ["user_id", "item_id", "label"]
+
+
+class TrainDevSplitter:
+    """
+    Splits the raw train interactions of every user in train and dev.
+    The raw file is read once, so several strategies can be computed from the same instance.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.interactions = pd.read_csv(RAW_DATA_PATH / dataset / "train.tsv", sep="\t", header=None)
+        # an optional fourth column holds the interaction timestamp
+        self.interactions.columns = (COLUMNS + ["timestamp"])[:len(self.interactions.columns)]
+
+        self.strategies = {
+            "fraction": self.fraction_dev,
+            "leave_last_out": self.leave_last_out_dev,
+            "temporal": self.temporal_dev,
+        }
+
+    def fraction_dev(self, dev_size, seed):
+        # one sampling pass over all users, reproducible for the same seed
+        return self.interactions.groupby("user_id").sample(frac=dev_size, random_state=seed)
+
+    def leave_last_out_dev(self, dev_size, seed):
+        # last interaction in file order of every user with at least two of them
+        sizes = self.interactions.groupby("user_id")["user_id"].transform("size")
+        return self.interactions.loc[sizes > 1].groupby("user_id").tail(1)
+
+    def temporal_dev(self, dev_size, seed):
+        if "timestamp" not in self.interactions.columns:
+            raise ValueError("Temporal split requires a timestamp column in %s train.tsv" % (self.dataset))
+
+        ordered = self.interactions.sort_values(by=["user_id", "timestamp"], kind="stable")
+        position = ordered.groupby("user_id").cumcount()
+        sizes = ordered.groupby("user_id")["user_id"].transform("size")
+        return ordered.loc[position >= sizes - (sizes * dev_size).round()]
+
+    def split(self, strategy="fraction", dev_size=0.2, seed=42):
+        if strategy not in self.strategies:
+            raise ValueError("Split strategy not found: %s" % (strategy))
+
+        dev = self.strategies[strategy](dev_size, seed)
+        train = self.interactions.drop(dev.index)
+
+        return train[COLUMNS], dev[COLUMNS]
+
+
 def main(params):
     dataset = params["dataset"]
-    train = pd.read_csv(RAW_DATA_PATH / dataset / "train.tsv", sep="\t", header=None)
-    train.columns = ["user_id", "item_id", "label"]
-    
-    dev_sets = []
-    for _, group in train.groupby("user_id"):
-        dev_group = group.sample(frac=params["dev_size"], random_state=params["seed"])
-        dev_sets.append(dev_group)
-        train = train.drop(dev_group.index)
-
-    dev = pd.concat(dev_sets)
-
-    (INTERIM_DATA_PATH / "dbbook").mkdir(parents=True, exist_ok=True)
+
+    splitter = TrainDevSplitter(dataset)
+    train, dev = splitter.split(
+        strategy=params.get("strategy", "fraction"),
+        dev_size=params["dev_size"],
+        seed=params["seed"])
+
+    (INTERIM_DATA_PATH / dataset).mkdir(parents=True, exist_ok=True)
     train.to_csv(INTERIM_DATA_PATH / dataset / "train.tsv", sep="\t", index=False, header=False)
     dev.to_csv(INTERIM_DATA_PATH / dataset / "dev.tsv", sep="\t", index=False, header=False)
 
     test = pd.read_csv(RAW_DATA_PATH / dataset / "test.tsv", sep="\t", header=None)
     test.to_csv(INTERIM_DATA_PATH / dataset / "test.tsv", sep="\t", index=False, header=False)
-    
+
 if __name__ == "__main__":
     params = yaml.safe_load(open("params.yaml"))["train_dev_split"]
-    main(params)
\ No newline at end of file
+    main(params)
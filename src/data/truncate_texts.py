@@ -1,5 +1,3 @@
-import pandas as pd
-
 import yaml
 
 from .paths import PROCESSED_DATA_PATH
@@ -9,31 +7,23 @@ from transformers import HfArgumentParser
 
 from ..utilities.setup_parameters import DynamicDataTrainingArguments
 from .dataset import TruncateDataset
+from .text_store import write_packed_texts, write_packed_token_ids
 
-def main(data_args: DynamicDataTrainingArguments):
+def main(data_args: DynamicDataTrainingArguments, tokenizer_name_or_path='google/flan-t5-base'):
     OUTPUT_PATH = PROCESSED_DATA_PATH / "dbbook"
 
-    tokenizer = AutoTokenizer.from_pretrained('google/flan-t5-base')
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name_or_path)
 
     dataset = (
         TruncateDataset(data_args, tokenizer=tokenizer, mode="train")
     )
 
-    dataset.texts = [
-        (int(text.split(";;")[0]), str(text.split(";;")[1])) 
-        for text in dataset.texts
-    ]
-    texts_df = pd.DataFrame(dataset.texts, columns=["item_id", "item_text"])
-
     OUTPUT_PATH.mkdir(parents=True, exist_ok=True)
-    (OUTPUT_PATH / "texts").mkdir(parents=True, exist_ok=True)
-
-    # save each row of texts df as a txt file in the processed data directory
-    for _, row in texts_df.iterrows():
-        item_id = row["item_id"]
-        item_text = row["item_text"]
-        with open(OUTPUT_PATH / "texts" / f"{item_id}.text", "w") as f:
-            f.write(item_text)
+
+    # pack all texts in one blob plus an index, instead of one file per item
+    write_packed_texts(OUTPUT_PATH, dataset.texts)
+    # the truncated token ids are kept, so prompts can be assembled without re-tokenizing the texts
+    write_packed_token_ids(OUTPUT_PATH, dataset.token_ids, tokenizer)
 
 if __name__ == '__main__':
     params = yaml.safe_load(open("params.yaml"))["truncate_texts"]
@@ -0,0 +1,168 @@
+import logging
+import time
+
+import pandas as pd
+
+from ..data.paths import INTERIM_DATA_PATH, PROCESSED_DATA_PATH
+
+logger = logging.getLogger(__name__)
+
+ITEM_PROP_COLUMNS = ['item_author', 'item_genre', 'item_series', 'item_publisher']
+
+
+def read_ranking_candidates():
+    candidates = pd.read_csv(
+        PROCESSED_DATA_PATH / "dbbook" / "test.tsv", sep='\t', header=None,
+        names=['user_id', 'item_id', 'label', 'user_genres', 'item_genre'],
+        dtype={'user_genres': 'str', 'item_genre': 'str'}, keep_default_na=False)
+    return candidates
+
+
+def read_train_positives():
+    train = pd.read_csv(
+        INTERIM_DATA_PATH / "dbbook" / "train.tsv", sep='\t', header=None,
+        names=['user_id', 'item_id', 'label'])
+    return train.loc[train.label == 1, ['user_id', 'item_id']]
+
+
+def read_item_prop_features():
+    # (item_id, feature) rows, one per property value, subjects are split in single values
+    items = pd.read_csv(
+        INTERIM_DATA_PATH / "dbbook" / "item-prop" / "train.tsv", sep='\t', header=None,
+        names=['item_id', *ITEM_PROP_COLUMNS, 'item_subject'],
+        dtype='str', keep_default_na=False)
+    items['item_id'] = items['item_id'].astype('int64')
+
+    single = items.melt(id_vars='item_id', value_vars=ITEM_PROP_COLUMNS, var_name='prop', value_name='value')
+    subject = items[['item_id', 'item_subject']].assign(value=items['item_subject'].str.split(','))
+    subject = subject.explode('value').assign(prop='item_subject')[['item_id', 'prop', 'value']]
+
+    features = pd.concat([single, subject])
+    features = features.loc[features.value != '']
+    features = features.assign(feature=features.prop + '=' + features.value)
+
+    return features[['item_id', 'feature']].drop_duplicates()
+
+
+def item_popularity(candidates, train_positives):
+    popularity = train_positives.groupby('item_id').size()
+    return candidates.item_id.map(popularity).fillna(0).to_numpy()
+
+
+def genre_overlap_scores(candidates, train_positives):
+    # 1 when the item genre is one of the liked genres of the user
+    liked = candidates.user_genres.str.split(', ')
+    return [
+        float(genre != '' and genre in genres)
+        for genre, genres in zip(candidates.item_genre.tolist(), liked.tolist())
+    ]
+
+
+def popularity_scores(candidates, train_positives):
+    return item_popularity(candidates, train_positives)
+
+
+def item_prop_scores(candidates, train_positives):
+    # sparse dot product of the user profile (property counts over liked train items) and the item properties
+    features = read_item_prop_features()
+    profiles = train_positives.merge(features, on='item_id').groupby(['user_id', 'feature']).size().rename('weight')
+
+    pairs = candidates[['user_id', 'item_id']].merge(features, on='item_id')
+    pairs = pairs.join(profiles, on=['user_id', 'feature'], how='inner')
+    scores = pairs.groupby(['user_id', 'item_id'])['weight'].sum()
+
+    return candidates.set_index(['user_id', 'item_id']).index.map(scores).fillna(0).to_numpy()
+
+
+prefilter_stages_mapping = {
+    "genre_overlap": genre_overlap_scores,
+    "popularity": popularity_scores,
+    "item_prop": item_prop_scores,
+}
+
+
+class CascadePrefilter:
+    """
+    Cheap first ranking stage, only the top-m candidates of every user are scored by the model.
+    """
+    def __init__(self, stage, top_m, report_m=()):
+        if stage not in prefilter_stages_mapping:
+            raise ValueError("Cascade prefilter not found: %s" % (stage))
+
+        self.stage = stage
+        self.top_m = top_m
+        self.report_m = sorted(set(report_m) | {top_m})
+
+    def select(self):
+        start = time.perf_counter()
+        candidates = read_ranking_candidates()
+        train_positives = read_train_positives()
+
+        # ties are broken by popularity, then by candidate order
+        candidates = candidates.assign(
+            stage_score=prefilter_stages_mapping[self.stage](candidates, train_positives),
+            popularity=item_popularity(candidates, train_positives))
+        ranked = candidates.sort_values(by=['user_id', 'stage_score', 'popularity'], ascending=[True, False, False], kind='stable')
+        kept = ranked.groupby('user_id', sort=False).head(self.top_m)
+        prefilter_seconds = time.perf_counter() - start
+
+        self.report = self.build_report(candidates, ranked, prefilter_seconds)
+        logger.info(
+            "Cascade %s top-%d: kept %d of %d candidates (%.2fx fewer), recall of test positives %.4f",
+            self.stage, self.top_m, self.report["kept"], self.report["candidates"],
+            self.report["candidate_reduction"], self.report["recall"])
+
+        return set(zip(kept.user_id.tolist(), kept.item_id.tolist()))
+
+    def build_report(self, candidates, ranked, prefilter_seconds):
+        """
+        Recall loss of the chosen top_m and of every m of report_m, from the first stage ranking only.
+        """
+        positives = int((candidates.label == 1).sum())
+        # position of every candidate in the first stage ranking of its user
+        positions = ranked.groupby('user_id', sort=False).cumcount().to_numpy()
+        is_positive = (ranked.label == 1).to_numpy()
+
+        tradeoff = []
+        for top_m in self.report_m:
+            kept = positions < top_m
+            kept_positives = int((kept & is_positive).sum())
+            recall = kept_positives / positives if positives else 1.0
+            tradeoff.append({
+                "top_m": top_m,
+                "kept": int(kept.sum()),
+                "candidate_reduction": len(candidates) / max(int(kept.sum()), 1),
+                "kept_positives": kept_positives,
+                "recall": recall,
+                "recall_loss": 1.0 - recall,
+            })
+
+        chosen = next(row for row in tradeoff if row["top_m"] == self.top_m)
+        return dict(
+            chosen,
+            stage=self.stage,
+            users=int(candidates.user_id.nunique()),
+            candidates=len(candidates),
+            positives=positives,
+            prefilter_seconds=prefilter_seconds,
+            tradeoff=tradeoff)
+
+    def speedup_report(self, candidates_per_sec, ranking_seconds, baseline_seconds=None):
+        """
+        Adds the speedups to the report: expected ones from the measured model throughput,
+        the model cost being linear in the scored candidates, and the measured one against a run without the cascade.
+        """
+        report = dict(self.report, ranking_seconds=ranking_seconds, candidates_per_sec=candidates_per_sec)
+        seconds_per_candidate = 1 / max(candidates_per_sec, 1e-9)
+        uncascaded_seconds = report["candidates"] * seconds_per_candidate
+        report["tradeoff"] = [
+            dict(row, expected_speedup=uncascaded_seconds / (report["prefilter_seconds"] + row["kept"] * seconds_per_candidate))
+            for row in report["tradeoff"]
+        ]
+        report["expected_speedup"] = next(row for row in report["tradeoff"] if row["top_m"] == self.top_m)["expected_speedup"]
+
+        if baseline_seconds is not None:
+            report["baseline_seconds"] = baseline_seconds
+            report["measured_speedup"] = baseline_seconds / (report["prefilter_seconds"] + ranking_seconds)
+
+        return report
@@ -1,10 +1,16 @@
+import json
 import logging
+import multiprocessing
 from pathlib import Path
 import sys
 import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
+import torch
 
 from typing import Callable, Dict
 from tqdm import tqdm
@@ -15,10 +21,18 @@ from transformers import (
     DataCollatorForSeq2Seq
 )
 from torch.utils.data import DataLoader
-from ..data.t5dataset import T5EvalAsRankDataset
+from ..data.t5dataset import get_ranking_dataset_class
+from ..data.samplers import LengthBucketBatchSampler
 
-from ..data.processors import num_labels_mapping, output_modes_mapping, compute_metrics_mapping
+from ..data.processors import num_labels_mapping, output_modes_mapping, compute_metrics_mapping, processors_mapping
+from ..utilities.profiling import ProfiledCollator, peak_rss_mb, profiler
 from ..utilities.setup_parameters import ModelArguments, DynamicDataTrainingArguments
+from .scoring import RankingScorer, get_verbalizer_token_ids
+from .score_cache import ScoreCache, CachedRankingScorer, checkpoint_fingerprint
+from .results import RankingWriter, ResumableRanking, merge_rankings
+from .cascade import CascadePrefilter
+from .quantization import quantize_model, ranking_agreement
+from .onnx_scoring import OnnxRankingScorer, get_onnx_model_path
 
 logger = logging.getLogger(__name__)
 
@@ -47,87 +61,430 @@ def build_compute_metrics_fn(task_name, tokenizer) -> Callable[[EvalPrediction],
     return compute_metrics_fn
 
 
-def main():
-    parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, Seq2SeqTrainingArguments))
+def roc_auc(scores, positive):
+    # Mann-Whitney U statistic with average ranks for ties
+    num_positive = positive.sum()
+    num_negative = len(positive) - num_positive
+    if num_positive == 0 or num_negative == 0:
+        return float("nan")
 
-    params_files = [
-        ('./params/flan-t5-base-dbbook-prompt-4.json', 4965),
-    ]
+    ranks = pd.Series(scores).rank(method="average").to_numpy()
+    return float((ranks[positive].sum() - num_positive * (num_positive + 1) / 2) / (num_positive * num_negative))
 
-    for params_file, checkpoint in params_files:
-        model_args, data_args, training_args = parser.parse_json_file(params_file)
-        data_args.task_name = "dbbook_ranking"
-        # Setup logging
-        logging.basicConfig(
-            format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-            datefmt="%m/%d/%Y %H:%M:%S",
-            level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
-        )
 
-        # Set seed
-        set_seed(training_args.seed)
-
-        # Log task info
-        try:
-            num_labels = num_labels_mapping[data_args.task_name]
-            output_mode = output_modes_mapping[data_args.task_name]
-            logger.info("Task name: {}, number of labels: {}, output mode: {}".format(data_args.task_name, num_labels, output_mode))
-        except KeyError:
-            raise ValueError("Task not found: %s" % (data_args.task_name))
-
-        # Create config
-        config = AutoConfig.from_pretrained(
-            model_args.model_name_or_path,
-            num_labels=num_labels,
-            finetuning_task=data_args.task_name,
-        )
+def build_logit_metrics_fn(positive_index) -> Callable[[EvalPrediction], Dict]:
+    """
+    Accuracy, AUC and log-loss of the dev labels from the verbalizer logits, nothing is decoded.
+    """
+    def compute_metrics_fn(p: EvalPrediction):
+        logits = p.predictions[0] if isinstance(p.predictions, tuple) else p.predictions
+        labels = p.label_ids.astype(np.int64)
+
+        logits = logits.astype(np.float64)
+        log_probs = logits - np.logaddexp.reduce(logits, axis=-1, keepdims=True)
+
+        return {
+            "acc": float((logits.argmax(axis=-1) == labels).mean()),
+            "auc": roc_auc(log_probs[:, positive_index], labels == positive_index),
+            "log_loss": float(-log_probs[np.arange(len(labels)), labels].mean()),
+        }
+
+    return compute_metrics_fn
+
+
+def build_ranking_dataloader(dataset, data_args, training_args, data_collator):
+    if not data_args.length_bucketing:
+        return DataLoader(
+            dataset, 
+            batch_size=training_args.per_device_eval_batch_size, 
+            shuffle=False,
+            collate_fn=data_collator)
+
+    # scores are scattered back by (user_id, item_id), so batches can be reordered by length
+    batch_sampler = LengthBucketBatchSampler(
+        dataset.get_lengths(),
+        batch_size=training_args.per_device_eval_batch_size,
+        max_tokens=data_args.max_tokens_per_batch,
+        shuffle=False)
+
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=data_collator)
+
+
+def rank_per_user(scorer, data_args, training_args, tokenizer, data_collator, user_id_list, candidates=None):
+    for user_id in tqdm(user_id_list):
+        user_dataset = (get_ranking_dataset_class(data_args.template)(
+            data_args, tokenizer=tokenizer, user_id=user_id, candidates=candidates))
+        user_dataloader = build_ranking_dataloader(user_dataset, data_args, training_args, data_collator)
+
+        scores = {}
+        for batch in user_dataloader:
+            batch_scores = scorer(batch["input_ids"], batch["attention_mask"])
+            scores.update(zip(batch["item_id"].tolist(), batch_scores.tolist()))
+
+        yield user_id, scores
+
 
-        set_seed(training_args.seed)
+def rank_cross_user(
+        scorer, data_args, training_args, tokenizer, data_collator, user_id_list, candidates=None, all_users=False):
+    # candidates of the users are streamed into full batches, scores are scattered back by user
+    dataset = (get_ranking_dataset_class(data_args.template)(
+        data_args, tokenizer=tokenizer, candidates=candidates, user_ids=None if all_users else user_id_list))
+    dataloader = build_ranking_dataloader(dataset, data_args, training_args, data_collator)
+    if data_args.length_bucketing:
+        dataloader.batch_sampler.log_padding_stats("ranking")
+
+    scores = {}
+    start = time.perf_counter()
+    for batch in tqdm(dataloader):
+        batch_scores = scorer(batch["input_ids"], batch["attention_mask"])
+        for user_id, item_id, score in zip(batch["user_id"].tolist(), batch["item_id"].tolist(), batch_scores.tolist()):
+            scores.setdefault(user_id, {})[item_id] = score
+    elapsed = time.perf_counter() - start
+    logger.info("Scored %d candidates in %.1fs (%.1f candidates/sec)", len(dataset), elapsed, len(dataset) / max(elapsed, 1e-9))
+
+    for user_id in user_id_list:
+        yield user_id, scores.get(user_id, {})
+
+
+def load_ranking_scorer(model_args, data_args, training_args, checkpoint_path, tokenizer=None):
+    # Log task info
+    try:
+        num_labels = num_labels_mapping[data_args.task_name]
+        output_mode = output_modes_mapping[data_args.task_name]
+        logger.info("Task name: {}, number of labels: {}, output mode: {}".format(data_args.task_name, num_labels, output_mode))
+    except KeyError:
+        raise ValueError("Task not found: %s" % (data_args.task_name))
+
+    # Create config
+    config = AutoConfig.from_pretrained(
+        model_args.model_name_or_path,
+        num_labels=num_labels,
+        finetuning_task=data_args.task_name,
+    )
+
+    set_seed(training_args.seed)
+    if tokenizer is None:
         tokenizer = AutoTokenizer.from_pretrained(model_args.model_name_or_path,)
 
+    if data_args.ranking_backend not in ["torch", "onnx"]:
+        raise ValueError("Ranking backend not found: %s" % (data_args.ranking_backend))
+    if data_args.ranking_backend == "onnx" and data_args.ranking_quantization is not None:
+        raise ValueError("Quantization is not supported with the onnx ranking backend")
+
+    # the onnx backend only needs the torch model to check parity
+    model = None
+    if data_args.ranking_backend == "torch" or data_args.ranking_scorer_check_batches > 0:
         model = AutoModelForSeq2SeqLM.from_pretrained(
-            training_args.output_dir + f'/checkpoint-{checkpoint}',
+            checkpoint_path,
             config=config
         )
+        if data_args.ranking_quantization is not None:
+            model = quantize_model(model, data_args.ranking_quantization)
+
         # Pass dataset and argument information to the model
         model.model_args = model_args
         model.data_args = data_args
         model.tokenizer = tokenizer
 
-        data_collator = DataCollatorForSeq2Seq(tokenizer, model=model, padding=True)
-
-        test_df = pd.read_csv(
-            './data/raw/dbbook/test.tsv', 
-            sep='\t', header=None, names=['user_id', 'item_id', 'label'])
-        user_id_list = test_df.user_id.unique().tolist()
-
-        for user_id in tqdm(user_id_list):
-            user_dataset = (T5EvalAsRankDataset(data_args, tokenizer=tokenizer, user_id=user_id))
-            user_dataloader = DataLoader(
-                user_dataset, 
-                batch_size=training_args.per_device_eval_batch_size, 
-                shuffle=False,
-                collate_fn=data_collator)
-            
-            scores = {}
-            for batch in user_dataloader:
-                output = model.generate(
-                    input_ids=batch["input_ids"],
-                    attention_mask=batch["attention_mask"],
-                    max_new_tokens=3, 
-                    output_scores=True, return_dict_in_generate=True)
-                scores.update({
-                    item_id.item(): score[333].item() 
-                    for item_id, score in zip(batch["item_id"], output.scores[0])
-                })
-
-            # sort scores by value
-            sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-
-            # write to file
-            Path('results').mkdir(parents=True, exist_ok=True)
-            with open(Path('results') / f"{params_file.split('.')[1].split('/')[2]}.txt", "a") as f:
-                for item_id, _ in sorted_scores:
-                    f.write(f"{user_id}\t{item_id}\n")
+    data_collator = DataCollatorForSeq2Seq(tokenizer, model=model, padding=True)
+    if data_args.profiling:
+        data_collator = ProfiledCollator(data_collator)
+
+    label_to_word = eval(data_args.mapping)
+    labels = processors_mapping[data_args.task_name].get_labels()
+    scorer = RankingScorer(
+        model,
+        token_ids=get_verbalizer_token_ids(tokenizer, label_to_word, labels),
+        positive_index=labels.index(1),
+        scorer=data_args.ranking_scorer,
+        score=data_args.ranking_score,
+        check_batches=data_args.ranking_scorer_check_batches,
+        quantization=data_args.ranking_quantization)
+
+    if data_args.ranking_backend == "onnx":
+        scorer = OnnxRankingScorer(
+            get_onnx_model_path(data_args, checkpoint_path),
+            scorer,
+            checkpoint_path,
+            intra_op_threads=data_args.onnx_intra_op_threads,
+            check_batches=data_args.ranking_scorer_check_batches)
+
+    score_cache = None
+    if data_args.score_cache_path is not None:
+        score_cache = ScoreCache(
+            data_args.score_cache_path,
+            namespace="|".join([
+                checkpoint_fingerprint(checkpoint_path),
+                tokenizer.name_or_path, str(len(tokenizer)),
+                scorer.signature()]),
+            max_entries=data_args.score_cache_max_entries)
+        scorer = CachedRankingScorer(scorer, score_cache)
+
+    return tokenizer, data_collator, scorer, score_cache
+
+
+def rank_users(
+        scorer, data_args, training_args, tokenizer, data_collator, user_id_list, candidates=None, all_users=False):
+    """
+    Ranks the candidates of the users, with all_users the list holds every test user
+    and the dataset of all candidates, which can be cached, is ranked.
+    """
+    if data_args.ranking_batching == "cross_user":
+        return rank_cross_user(
+            scorer, data_args, training_args, tokenizer, data_collator, user_id_list, candidates, all_users)
+    elif data_args.ranking_batching == "per_user":
+        return rank_per_user(scorer, data_args, training_args, tokenizer, data_collator, user_id_list, candidates)
+    else:
+        raise ValueError("Ranking batching not found: %s" % (data_args.ranking_batching))
+
+
+def ranking_run_signature(model_args, data_args, checkpoint_path):
+    # everything that changes the ranking of a user, results of runs that differ in one of them are not mixed
+    return {
+        "checkpoint": checkpoint_fingerprint(checkpoint_path),
+        "tokenizer": model_args.model_name_or_path,
+        "template": data_args.template,
+        "mapping": data_args.mapping,
+        "pretokenize_template": data_args.pretokenize_template,
+        "score": data_args.ranking_score,
+        "backend": data_args.ranking_backend,
+        "quantization": data_args.ranking_quantization,
+        "cascade_prefilter": data_args.cascade_prefilter,
+        "cascade_top_m": data_args.cascade_top_m if data_args.cascade_prefilter is not None else None,
+    }
+
+
+def shard_users(user_id_list, num_shards):
+    # round robin over the test user order, the same users always land in the same shard
+    return [user_id_list[shard::num_shards] for shard in range(num_shards)]
+
+
+def shard_cores(num_shards, threads_per_worker=None):
+    cores = sorted(os.sched_getaffinity(0))
+    threads = threads_per_worker or max(1, len(cores) // num_shards)
+    return threads, [cores[shard * threads:(shard + 1) * threads] for shard in range(num_shards)]
+
+
+def rank_shard(params_file, checkpoint, shard, user_id_list, candidates, threads, cores, shard_path):
+    """
+    Ranks one shard of users in a worker process with its own model copy and writes a binary shard file.
+    """
+    torch.set_num_threads(threads)
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+    parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, Seq2SeqTrainingArguments))
+    model_args, data_args, training_args = parser.parse_json_file(params_file)
+    data_args.task_name = "dbbook_ranking"
+    logging.basicConfig(
+        format=f"%(asctime)s - %(levelname)s - shard {shard} - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
+    )
+    set_seed(training_args.seed)
+    profiler.reset(enabled=data_args.profiling)
+
+    checkpoint_path = training_args.output_dir + f'/checkpoint-{checkpoint}'
+    tokenizer, data_collator, scorer, score_cache = load_ranking_scorer(model_args, data_args, training_args, checkpoint_path)
+
+    num_candidates = 0
+    start = time.perf_counter()
+    with RankingWriter(shard_path, binary=True, tsv=False) as writer:
+        for user_id, scores in rank_users(
+                scorer, data_args, training_args, tokenizer, data_collator, user_id_list, candidates):
+            writer.write(user_id, scores)
+            num_candidates += len(scores)
+    elapsed = time.perf_counter() - start
+
+    if score_cache is not None:
+        score_cache.close()
+
+    return {
+        "shard": shard, "users": len(user_id_list), "candidates": num_candidates, "seconds": elapsed,
+        "profile": profiler.state()}
+
+
+def rank_sharded(params_file, checkpoint, data_args, user_id_list, candidates, results_path):
+    """
+    Ranks users across a pool of worker processes, pinned to disjoint core groups, returns the shard files.
+    """
+    num_workers = data_args.ranking_workers
+    threads, cores = shard_cores(num_workers, data_args.ranking_threads_per_worker)
+    if not data_args.ranking_pin_cores:
+        cores = [None] * num_workers
+
+    shards_dir = Path(str(results_path) + "-shards")
+    shards_dir.mkdir(parents=True, exist_ok=True)
+    shard_paths = [shards_dir / f"shard-{shard}" for shard in range(num_workers)]
+
+    # spawn, so the workers do not inherit the torch thread pools of the parent
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(
+                rank_shard, params_file, checkpoint, shard, shard_user_ids, candidates,
+                threads, cores[shard], shard_paths[shard])
+            for shard, shard_user_ids in enumerate(shard_users(user_id_list, num_workers))
+        ]
+        shard_reports = [future.result() for future in futures]
+
+    for report in shard_reports:
+        logger.info(
+            "Shard %d: %d users, %d candidates in %.1fs (%.1f candidates/sec)",
+            report["shard"], report["users"], report["candidates"], report["seconds"],
+            report["candidates"] / max(report["seconds"], 1e-9))
+        profiler.merge(report["profile"])
+
+    return shard_paths
+
+
+def uncascaded_baseline(scaling_path, scaling):
+    # latest run of the params without the cascade, on the same backend, quantization and workers
+    if not scaling_path.exists():
+        return None
+
+    keys = ["workers", "threads_per_worker", "pinned", "backend", "quantization"]
+    baseline = None
+    with open(scaling_path) as f:
+        for line in f:
+            run = json.loads(line)
+            if "cascade_prefilter" in run and run["cascade_prefilter"] is None and all(run.get(key) == scaling[key] for key in keys):
+                baseline = run
+
+    return baseline
+
+
+def run_eval(params_file, checkpoint, tokenizer=None):
+    """
+    Ranks the test candidates with a checkpoint of one params file, returns the timing of the run.
+    """
+    parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, Seq2SeqTrainingArguments))
+    model_args, data_args, training_args = parser.parse_json_file(params_file)
+    data_args.task_name = "dbbook_ranking"
+    # Setup logging
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
+    )
+
+    # Set seed
+    set_seed(training_args.seed)
+    profiler.reset(enabled=data_args.profiling)
+
+    test_df = pd.read_csv(
+        './data/raw/dbbook/test.tsv', 
+        sep='\t', header=None, names=['user_id', 'item_id', 'label'])
+    user_id_list = test_df.user_id.unique().tolist()
+
+    # only the top-m candidates of the cheap first stage are scored by the model
+    cascade, candidates = None, None
+    if data_args.cascade_prefilter is not None:
+        cascade = CascadePrefilter(data_args.cascade_prefilter, data_args.cascade_top_m, data_args.cascade_report_m)
+        candidates = cascade.select()
+
+    results_name = Path(params_file).stem
+    results_path = Path('results') / results_name
+    checkpoint_path = training_args.output_dir + f'/checkpoint-{checkpoint}'
+    num_candidates = 0
+    start = time.perf_counter()
+
+    if data_args.ranking_workers > 1:
+        threads, _ = shard_cores(data_args.ranking_workers, data_args.ranking_threads_per_worker)
+        score_cache = None
+
+        def rank(users, all_users=False):
+            shard_paths = rank_sharded(params_file, checkpoint, data_args, users, candidates, results_path)
+            return merge_rankings(shard_paths, users)
+    else:
+        threads = torch.get_num_threads()
+        tokenizer, data_collator, scorer, score_cache = load_ranking_scorer(
+            model_args, data_args, training_args, checkpoint_path, tokenizer=tokenizer)
+
+        def rank(users, all_users=False):
+            return rank_users(
+                scorer, data_args, training_args, tokenizer, data_collator, users, candidates, all_users)
+
+    if data_args.ranking_part_users is not None:
+        # completed users are skipped, every part of users is committed as soon as it is ranked
+        resumable = ResumableRanking(
+            Path('results') / f"{results_name}-parts",
+            ranking_run_signature(model_args, data_args, checkpoint_path))
+        completed = resumable.completed_users()
+        remaining = [user_id for user_id in user_id_list if user_id not in completed]
+
+        for part_start in range(0, len(remaining), data_args.ranking_part_users):
+            part_users = remaining[part_start:part_start + data_args.ranking_part_users]
+            resumable.write_part(rank(part_users))
+            logger.info("Completed %d of %d users", len(completed) + part_start + len(part_users), len(user_id_list))
+
+        ranked_users = resumable.merge(user_id_list)
+    else:
+        ranked_users = rank(user_id_list, all_users=True)
+
+    # rankings are compared on the full binary results
+    with RankingWriter(
+            results_path,
+            top_k=data_args.ranking_top_k,
+            binary=data_args.ranking_binary or data_args.ranking_reference_results is not None) as writer:
+        for user_id, scores in ranked_users:
+            writer.write(user_id, scores)
+            num_candidates += len(scores)
+    elapsed = time.perf_counter() - start
+
+    # one line per run, so candidates/sec can be compared across worker counts
+    scaling = {
+        "workers": data_args.ranking_workers,
+        "threads_per_worker": threads,
+        "pinned": data_args.ranking_pin_cores,
+        "backend": data_args.ranking_backend,
+        "quantization": data_args.ranking_quantization,
+        "cascade_prefilter": data_args.cascade_prefilter,
+        "cascade_top_m": data_args.cascade_top_m if cascade is not None else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "candidates": num_candidates,
+        "seconds": elapsed,
+        "candidates_per_sec": num_candidates / max(elapsed, 1e-9),
+    }
+    logger.info(
+        "Ranked %d candidates with %d worker(s) x %d thread(s) in %.1fs (%.1f candidates/sec)",
+        num_candidates, scaling["workers"], threads, elapsed, scaling["candidates_per_sec"])
+    scaling_path = Path('results') / f"{results_name}-scaling.jsonl"
+    baseline = uncascaded_baseline(scaling_path, scaling) if cascade is not None else None
+    with open(scaling_path, "a") as f:
+        f.write(json.dumps(scaling) + "\n")
+
+    if data_args.ranking_reference_results is not None:
+        agreement = ranking_agreement(data_args.ranking_reference_results, results_path)
+        logger.info("Agreement with %s: %s", data_args.ranking_reference_results, agreement)
+        with open(Path('results') / f"{results_name}-agreement.json", "w") as f:
+            json.dump(dict(agreement, reference=data_args.ranking_reference_results, **scaling), f, indent=2)
+
+    if cascade is not None:
+        report = cascade.speedup_report(
+            scaling["candidates_per_sec"], elapsed, baseline["seconds"] if baseline is not None else None)
+        report["scored_candidates"] = num_candidates
+        logger.info(
+            "Cascade expected speedup %.2fx, measured %s", report["expected_speedup"],
+            "%.2fx" % report["measured_speedup"] if baseline is not None else "- (no run without the cascade)")
+        with open(Path('results') / f"{results_name}-cascade.json", "w") as f:
+            json.dump(report, f, indent=2)
+
+    if score_cache is not None:
+        score_cache.close()
+
+    profiler.export(results_name, "eval", params_file)
+
+    return scaling
+
+
+
+def main():
+    params_files = [
+        ('./params/flan-t5-base-dbbook-prompt-4.json', 4965),
+    ]
+
+    for params_file, checkpoint in params_files:
+        run_eval(params_file, checkpoint)
+
 if __name__ == "__main__":
     main()
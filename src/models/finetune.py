@@ -2,82 +2,120 @@ import logging
 import os
 import sys
 
+from pathlib import Path
+
 from transformers import (
     set_seed, AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM, 
-    DataCollatorForSeq2Seq, HfArgumentParser, Seq2SeqTrainer,
+    DataCollatorForSeq2Seq, HfArgumentParser,
     Seq2SeqTrainingArguments
 )
 
-from ..data.t5dataset import T5PromptingDataset
-from ..data.processors import num_labels_mapping, output_modes_mapping
+from ..data.t5dataset import get_prompting_dataset_class
+from ..data.processors import num_labels_mapping, output_modes_mapping, processors_mapping
+from ..utilities.cpu import configure_cpu_training
+from ..utilities.profiling import ProfiledCollator, profiler
 from ..utilities.setup_parameters import (
     ModelArguments, DynamicDataTrainingArguments
 )
-from .eval import build_compute_metrics_fn
+from .eval import build_compute_metrics_fn, build_logit_metrics_fn
+from .scoring import get_verbalizer_token_ids
+from .trainer import PromptingSeq2SeqTrainer
 
 logger = logging.getLogger(__name__)
 
-def main():
+def build_trainer(model_args, data_args, training_args, tokenizer=None):
+    # Log task info
+    try:
+        num_labels = num_labels_mapping[data_args.task_name]
+        output_mode = output_modes_mapping[data_args.task_name]
+        logger.info(
+            f"Task name: {data_args.task_name}, number of labels: {num_labels}, output mode: {output_mode}")
+    except KeyError:
+        raise ValueError(f"Task not found: {data_args.task_name}")
+
+    # Create config
+    config = AutoConfig.from_pretrained(
+        model_args.model_name_or_path,
+        num_labels=num_labels,
+        finetuning_task=data_args.task_name,
+    )
+
+    if tokenizer is None:
+        tokenizer = AutoTokenizer.from_pretrained(model_args.model_name_or_path)
+
+    dataset_class = get_prompting_dataset_class(data_args.template)
+    train_dataset = (dataset_class(data_args, tokenizer=tokenizer, mode="train"))
+    eval_dataset = (dataset_class(data_args, tokenizer=tokenizer, mode="dev"))
+
+    set_seed(training_args.seed)
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(
+        model_args.model_name_or_path,
+        config=config,
+    )
+
+    data_collator = DataCollatorForSeq2Seq(tokenizer, model=model)
+    if data_args.profiling:
+        data_collator = ProfiledCollator(data_collator)
+
+    # Pass dataset and argument information to the model
+    model.model_args = model_args
+    model.data_args = data_args
+    model.tokenizer = tokenizer
+
+    labels = processors_mapping[data_args.task_name].get_labels()
+    if data_args.validation_mode == "logits":
+        compute_metrics = build_logit_metrics_fn(labels.index(1))
+    else:
+        compute_metrics = build_compute_metrics_fn(eval_dataset.args.task_name, tokenizer)
+
+    # Initialize our Trainer
+    trainer = PromptingSeq2SeqTrainer(
+        model=model,
+        args=training_args,
+        data_args=data_args,
+        train_dataset=train_dataset,
+        data_collator=data_collator,
+        eval_dataset=eval_dataset,
+        compute_metrics=compute_metrics,
+        verbalizer_token_ids=get_verbalizer_token_ids(tokenizer, eval(data_args.mapping), labels)
+    )
+
+    return trainer
+
+
+def run_finetune(params_file, tokenizer=None):
+    """
+    Finetunes the model of one params file, returns the train metrics and the last dev metrics.
+    """
     parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, Seq2SeqTrainingArguments))
-    for params_file in ["./params/flan-t5-base-dbbook-prompt-4.json"]:
-        model_args, data_args, training_args = parser.parse_json_file(params_file)
-
-        # Setup logging
-        logging.basicConfig(
-            format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
-            datefmt="%m/%d/%Y %H:%M:%S",
-            level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
-        )
-
-        # Set seed
-        set_seed(training_args.seed)
-
-        # Log task info
-        try:
-            num_labels = num_labels_mapping[data_args.task_name]
-            output_mode = output_modes_mapping[data_args.task_name]
-            logger.info(
-                f"Task name: {data_args.task_name}, number of labels: {num_labels}, output mode: {output_mode}")
-        except KeyError:
-            raise ValueError(f"Task not found: {data_args.task_name}")
-
-        # Create config
-        config = AutoConfig.from_pretrained(
-            model_args.model_name_or_path,
-            num_labels=num_labels,
-            finetuning_task=data_args.task_name,
-        )
+    model_args, data_args, training_args = parser.parse_json_file(params_file)
 
-        tokenizer = AutoTokenizer.from_pretrained(model_args.model_name_or_path)
+    # Setup logging
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
+    )
 
-        train_dataset = (T5PromptingDataset(data_args, tokenizer=tokenizer, mode="train"))
-        eval_dataset = (T5PromptingDataset(data_args, tokenizer=tokenizer, mode="dev"))
+    # Set seed
+    set_seed(training_args.seed)
+    profiler.reset(enabled=data_args.profiling)
+    training_args = configure_cpu_training(data_args, training_args)
 
-        set_seed(training_args.seed)
+    trainer = build_trainer(model_args, data_args, training_args, tokenizer=tokenizer)
+    train_output = trainer.train()
 
-        model = AutoModelForSeq2SeqLM.from_pretrained(
-            model_args.model_name_or_path,
-            config=config,
-        )
+    profiler.export(Path(params_file).stem, "finetune", params_file)
 
-        data_collator = DataCollatorForSeq2Seq(tokenizer, model=model)
+    eval_logs = [logs for logs in trainer.state.log_history if "eval_loss" in logs]
+    return dict(train_output.metrics, **(eval_logs[-1] if eval_logs else {}))
 
-        # Pass dataset and argument information to the model
-        model.model_args = model_args
-        model.data_args = data_args
-        model.tokenizer = tokenizer
 
-        # Initialize our Trainer
-        trainer = Seq2SeqTrainer(
-            model=model,
-            args=training_args,
-            train_dataset=train_dataset,
-            data_collator=data_collator,
-            eval_dataset=eval_dataset,
-            compute_metrics=build_compute_metrics_fn(eval_dataset.args.task_name, tokenizer)
-        )
+def main():
+    for params_file in ["./params/flan-t5-base-dbbook-prompt-4.json"]:
+        run_finetune(params_file)
 
-        trainer.train()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,192 @@
+import argparse
+import logging
+
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from transformers import (
+    AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM,
+    HfArgumentParser, Seq2SeqTrainingArguments, DataCollatorForSeq2Seq
+)
+
+from ..data.t5dataset import get_ranking_dataset_class
+from ..data.processors import processors_mapping
+from ..utilities.profiling import profiler
+from ..utilities.setup_parameters import ModelArguments, DynamicDataTrainingArguments
+from .score_cache import checkpoint_fingerprint
+from .scoring import RankingScorer, forward_first_step_logits, get_verbalizer_token_ids, select_verbalizer_scores
+
+logger = logging.getLogger(__name__)
+
+
+def get_onnx_model_path(data_args, checkpoint_path):
+    # in a subdirectory, so the checkpoint fingerprint of the score cache does not change
+    if data_args.onnx_model_path is not None:
+        return data_args.onnx_model_path
+    return str(Path(checkpoint_path) / "onnx" / f"scorer-{data_args.ranking_score}.onnx")
+
+
+class VerbalizerScoresModule(torch.nn.Module):
+    """
+    Encoder plus one decoder step, reduced to the verbalizer scores, the graph that is exported.
+    """
+    def __init__(self, model, token_ids, score):
+        super().__init__()
+        self.model = model
+        self.token_ids = token_ids
+        self.score = score
+
+    def forward(self, input_ids, attention_mask):
+        logits = forward_first_step_logits(self.model, input_ids, attention_mask)
+        return select_verbalizer_scores(logits, self.token_ids, score=self.score)
+
+
+def export_onnx_scorer(scorer, output_path, checkpoint_path, opset=17):
+    import onnx
+
+    module = VerbalizerScoresModule(scorer.model, scorer.token_ids, scorer.score).eval()
+
+    # a padded row, so the attention mask is part of the traced graph
+    input_ids = torch.full((2, 8), 5, dtype=torch.long)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 4:] = 0
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    torch.onnx.export(
+        module,
+        (input_ids, attention_mask),
+        output_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["scores"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "scores": {0: "batch"},
+        },
+        opset_version=opset,
+        dynamo=False)
+
+    onnx_model = onnx.load(output_path)
+    # the graph outlives a retrain into the same checkpoint directory, so it records the weights it was exported from
+    onnx.helper.set_model_props(onnx_model, {
+        "signature": scorer.signature(),
+        "checkpoint": checkpoint_fingerprint(checkpoint_path),
+    })
+    onnx.save(onnx_model, output_path)
+
+    logger.info("Exported scoring graph to %s", output_path)
+
+
+class OnnxRankingScorer:
+    """
+    Scores candidates with an exported scoring graph on ONNX Runtime, optionally checked against the torch scorer.
+    """
+    def __init__(self, model_path, scorer, checkpoint_path, intra_op_threads=None, check_batches=0):
+        import onnxruntime
+
+        if not Path(model_path).exists():
+            raise ValueError("Scoring graph not found: %s, export it with src.models.onnx_scoring" % (model_path))
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.scorer = scorer
+        self.check_batches = check_batches if scorer.model is not None else 0
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if metadata.get("signature") != scorer.signature():
+            raise ValueError(
+                "Scoring graph %s was exported for %s, not %s" % (model_path, metadata.get("signature"), scorer.signature()))
+        if metadata.get("checkpoint") != checkpoint_fingerprint(checkpoint_path):
+            raise ValueError(
+                "Scoring graph %s was not exported from the current %s, export it again" % (model_path, checkpoint_path))
+
+    def signature(self):
+        return f"{self.scorer.signature()};backend=onnx"
+
+    def __call__(self, input_ids, attention_mask):
+        with profiler.stage("model_forward"):
+            scores = self.session.run(["scores"], {
+                "input_ids": input_ids.numpy().astype(np.int64),
+                "attention_mask": attention_mask.numpy().astype(np.int64),
+            })[0]
+        with profiler.stage("score_extraction"):
+            scores = torch.from_numpy(scores[:, self.scorer.positive_index])
+
+        if self.check_batches > 0:
+            self.check_batches -= 1
+            self.check_torch_parity(input_ids, attention_mask, scores)
+
+        return scores
+
+    def check_torch_parity(self, input_ids, attention_mask, scores):
+        torch_scores = self.scorer.verbalizer_scores(input_ids, attention_mask, scorer="forward")[:, self.scorer.positive_index]
+
+        same_ranking = torch.equal(
+            torch.argsort(scores, descending=True, stable=True),
+            torch.argsort(torch_scores, descending=True, stable=True))
+        max_diff = (scores - torch_scores).abs().max().item()
+
+        # rankings may only differ on near ties
+        if not same_ranking and not torch.allclose(scores, torch_scores, rtol=1e-4, atol=1e-4):
+            raise ValueError("ONNX scores rank candidates differently from torch (max score difference %f)" % (max_diff))
+
+        logger.info("ONNX scores match the torch ranking (max score difference %g)", max_diff)
+
+
+def main():
+    cli_parser = argparse.ArgumentParser()
+    cli_parser.add_argument("--check-only", action="store_true", help="Only check an exported graph against torch")
+    cli_parser.add_argument("--check-batches", type=int, default=1, help="Ranking batches compared with torch")
+    cli_args = cli_parser.parse_args()
+
+    parser = HfArgumentParser((ModelArguments, DynamicDataTrainingArguments, Seq2SeqTrainingArguments))
+
+    params_files = [
+        ('./params/flan-t5-base-dbbook-prompt-4.json', 4965),
+    ]
+
+    for params_file, checkpoint in params_files:
+        model_args, data_args, training_args = parser.parse_json_file(params_file)
+        data_args.task_name = "dbbook_ranking"
+        logging.basicConfig(
+            format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+            datefmt="%m/%d/%Y %H:%M:%S",
+            level=logging.INFO,
+        )
+
+        config = AutoConfig.from_pretrained(model_args.model_name_or_path, finetuning_task=data_args.task_name)
+        tokenizer = AutoTokenizer.from_pretrained(model_args.model_name_or_path,)
+
+        checkpoint_path = training_args.output_dir + f'/checkpoint-{checkpoint}'
+        model = AutoModelForSeq2SeqLM.from_pretrained(checkpoint_path, config=config).eval()
+
+        label_to_word = eval(data_args.mapping)
+        labels = processors_mapping[data_args.task_name].get_labels()
+        scorer = RankingScorer(
+            model,
+            token_ids=get_verbalizer_token_ids(tokenizer, label_to_word, labels),
+            positive_index=labels.index(1),
+            score=data_args.ranking_score)
+
+        output_path = get_onnx_model_path(data_args, checkpoint_path)
+        if not cli_args.check_only:
+            export_onnx_scorer(scorer, output_path, checkpoint_path)
+
+        # parity on the first ranking prompts, padded together
+        dataset = get_ranking_dataset_class(data_args.template)(data_args, tokenizer=tokenizer)
+        onnx_scorer = OnnxRankingScorer(output_path, scorer, checkpoint_path, check_batches=cli_args.check_batches)
+        data_collator = DataCollatorForSeq2Seq(tokenizer, padding=True)
+        batch_size = training_args.per_device_eval_batch_size
+        for start in range(0, min(cli_args.check_batches * batch_size, len(dataset)), batch_size):
+            batch = data_collator([dataset[i] for i in range(start, min(start + batch_size, len(dataset)))])
+            onnx_scorer(batch["input_ids"], batch["attention_mask"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import io
+import logging
+
+import numpy as np
+import torch
+
+from .results import load_rankings
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ["dynamic_int8"]
+
+
+def model_size_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def quantize_model(model, mode):
+    """
+    Returns the model with dynamically quantized Linear layers for CPU inference.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError("Quantization not found: %s" % (mode))
+
+    fp32_bytes = model_size_bytes(model)
+    model = torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+    logger.info(
+        "Quantized model with %s: %.1f MB -> %.1f MB",
+        mode, fp32_bytes / 2**20, model_size_bytes(model) / 2**20)
+
+    return model
+
+
+def kendall_tau(a, b):
+    """
+    Kendall tau-b between two score vectors over the same items.
+    """
+    if len(a) < 2:
+        return 1.0
+
+    upper = np.triu_indices(len(a), k=1)
+    sign_a = np.sign(a[:, None] - a[None, :])[upper]
+    sign_b = np.sign(b[:, None] - b[None, :])[upper]
+
+    denominator = np.sqrt(np.count_nonzero(sign_a) * np.count_nonzero(sign_b))
+    return float((sign_a * sign_b).sum() / denominator) if denominator else 1.0
+
+
+def ranking_agreement(reference_path, path, ks=(5, 10, 20)):
+    """
+    Mean overlap@k and Kendall tau per user between two binary results files.
+    """
+    rankings = []
+    for results_path in (reference_path, path):
+        user_ids, item_ids, scores = load_rankings(results_path)
+        starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]]) if len(user_ids) else []
+        ends = np.r_[starts[1:], len(user_ids)] if len(user_ids) else []
+        rankings.append({
+            int(user_ids[start]): (item_ids[start:end], scores[start:end])
+            for start, end in zip(starts, ends)
+        })
+    reference, other = rankings
+
+    overlaps = {k: [] for k in ks}
+    taus = []
+    for user_id in reference.keys() & other.keys():
+        reference_items, reference_scores = reference[user_id]
+        items, scores = other[user_id]
+
+        for k in ks:
+            overlaps[k].append(len(set(reference_items[:k].tolist()) & set(items[:k].tolist())) / min(k, len(reference_items)))
+
+        # tau over the items scored in both runs
+        _, reference_index, index = np.intersect1d(reference_items, items, return_indices=True)
+        taus.append(kendall_tau(reference_scores[reference_index].astype(np.float64), scores[index].astype(np.float64)))
+
+    return {
+        "users": len(taus),
+        **{f"overlap@{k}": float(np.mean(overlaps[k])) if taus else None for k in ks},
+        "kendall_tau": float(np.mean(taus)) if taus else None,
+    }
@@ -0,0 +1,218 @@
+import argparse
+import json
+import logging
+import os
+
+from pathlib import Path
+
+import numpy as np
+
+from ..utilities.profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+BINARY_SUFFIX = ".npz"
+TSV_SUFFIX = ".txt"
+TMP_SUFFIX = ".tmp"
+MANIFEST_FILE = "manifest.json"
+
+
+def results_file(path, suffix):
+    # appended rather than replaced, a results name may contain dots, e.g. prompt-4.1
+    path = Path(path)
+    return path if path.name.endswith(suffix) else path.parent / f"{path.name}{suffix}"
+
+
+def select_top_k(scores, top_k=None):
+    """
+    Positions of the top-k scores, best first, ties kept in input order as a stable full sort would.
+    """
+    if top_k is not None and top_k < len(scores):
+        # everything scoring at least the k-th best score, then a stable sort of that subset
+        threshold = -np.partition(-scores, top_k - 1)[top_k - 1]
+        candidates = np.flatnonzero(scores >= threshold)
+        order = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return order[:top_k]
+
+    return np.argsort(-scores, kind="stable")
+
+
+def write_tsv_rows(f, user_id, item_ids):
+    f.write("".join(f"{user_id}\t{item_id}\n" for item_id in item_ids))
+
+
+class RankingWriter:
+    """
+    Results sink of the ranking eval: a buffered TSV of the top-k items of every user for elliot,
+    and optionally the full rankings with their scores as compact binary arrays.
+    Files are written under a temporary name and only replace the previous results once complete.
+    """
+    def __init__(self, path, top_k=None, binary=False, tsv=True, buffering=1 << 20):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.top_k = top_k
+        self.binary = binary
+
+        self.tsv_path = results_file(self.path, TSV_SUFFIX)
+        self.tsv = open(self.tsv_path.with_name(self.tsv_path.name + TMP_SUFFIX), "w", buffering=buffering) if tsv else None
+        self.user_ids = []
+        self.item_ids = []
+        self.scores = []
+
+    def write(self, user_id, scores):
+        with profiler.stage("result_io"):
+            self.write_user(user_id, scores)
+
+    def write_user(self, user_id, scores):
+        item_ids = np.fromiter(scores.keys(), dtype=np.int64, count=len(scores))
+        values = np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+
+        if self.binary:
+            # the binary file keeps every candidate, so rankings can be re-cut at any k
+            order = select_top_k(values)
+            self.user_ids.append(np.full(len(order), user_id, dtype=np.int64))
+            self.item_ids.append(item_ids[order])
+            self.scores.append(values[order].astype(np.float32))
+            if self.tsv is not None:
+                write_tsv_rows(self.tsv, user_id, item_ids[order[:self.top_k]].tolist())
+        elif self.tsv is not None:
+            write_tsv_rows(self.tsv, user_id, item_ids[select_top_k(values, self.top_k)].tolist())
+
+    def close(self, commit=True):
+        with profiler.stage("result_io"):
+            self.close_files(commit)
+
+    def close_files(self, commit):
+        if self.tsv is not None:
+            self.tsv.close()
+            if not commit:
+                os.remove(self.tsv.name)
+        if not commit:
+            return
+
+        if self.binary:
+            binary_path = results_file(self.path, BINARY_SUFFIX)
+            with open(binary_path.with_name(binary_path.name + TMP_SUFFIX), "wb") as f:
+                np.savez(
+                    f,
+                    user_id=np.concatenate(self.user_ids) if self.user_ids else np.empty(0, dtype=np.int64),
+                    item_id=np.concatenate(self.item_ids) if self.item_ids else np.empty(0, dtype=np.int64),
+                    score=np.concatenate(self.scores) if self.scores else np.empty(0, dtype=np.float32))
+            os.replace(f.name, binary_path)
+
+        if self.tsv is not None:
+            os.replace(self.tsv.name, self.tsv_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # a failed run leaves the previous results in place
+        self.close(commit=exc_type is None)
+
+
+def load_rankings(path):
+    """
+    Returns user ids, item ids and scores of a binary results file, rows of a user are contiguous and best first.
+    """
+    with np.load(results_file(path, BINARY_SUFFIX)) as rankings:
+        return rankings["user_id"], rankings["item_id"], rankings["score"]
+
+
+def merge_rankings(paths, user_id_list):
+    """
+    Yields (user_id, scores) in the order of user_id_list from binary results files of disjoint users.
+    """
+    rankings = {}
+    for path in paths:
+        user_ids, item_ids, scores = load_rankings(path)
+        starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]]) if len(user_ids) else []
+        ends = np.r_[starts[1:], len(user_ids)] if len(user_ids) else []
+        for start, end in zip(starts, ends):
+            rankings[int(user_ids[start])] = dict(zip(item_ids[start:end].tolist(), scores[start:end].tolist()))
+
+    for user_id in user_id_list:
+        yield user_id, rankings.get(user_id, {})
+
+
+class ResumableRanking:
+    """
+    Rankings written as atomic binary parts of a few users each, with a manifest of the completed parts.
+    A run with a different signature, e.g. another checkpoint or template, is refused.
+    """
+    def __init__(self, parts_dir, signature):
+        self.parts_dir = Path(parts_dir)
+        self.parts_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.parts_dir / MANIFEST_FILE
+
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+            changed = sorted(
+                key for key in signature.keys() | self.manifest["signature"].keys()
+                if signature.get(key) != self.manifest["signature"].get(key))
+            if changed:
+                raise ValueError(
+                    "Results in %s were computed with a different %s, remove them to start over"
+                    % (self.parts_dir, ", ".join(changed)))
+
+            logger.info("Resuming from %d completed users in %s", len(self.completed_users()), self.parts_dir)
+        else:
+            self.manifest = {"signature": signature, "parts": []}
+            self.save_manifest()
+
+    def completed_users(self):
+        return {user_id for part in self.manifest["parts"] for user_id in part["users"]}
+
+    def write_part(self, ranked_users):
+        # a part written by a run that died before updating the manifest is overwritten
+        part_path = self.parts_dir / f"part-{len(self.manifest['parts']):05d}"
+        users = []
+        with RankingWriter(part_path, binary=True, tsv=False) as writer:
+            for user_id, scores in ranked_users:
+                writer.write(user_id, scores)
+                users.append(user_id)
+
+        self.manifest["parts"].append({"file": part_path.name, "users": users})
+        self.save_manifest()
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path.with_name(MANIFEST_FILE + TMP_SUFFIX)
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def merge(self, user_id_list):
+        return merge_rankings([self.parts_dir / part["file"] for part in self.manifest["parts"]], user_id_list)
+
+
+def user_ranks(user_ids):
+    # position of every row within its user block
+    starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]]) if len(user_ids) else np.empty(0, dtype=np.int64)
+    lengths = np.diff(np.r_[starts, len(user_ids)])
+    return np.arange(len(user_ids)) - np.repeat(starts, lengths)
+
+
+def recut_rankings(path, output_path, top_k):
+    """
+    Writes the TSV view of a binary results file cut at a new k without re-running the model.
+    """
+    user_ids, item_ids, _ = load_rankings(path)
+    keep = user_ranks(user_ids) < top_k
+
+    with open(output_path, "w", buffering=1 << 20) as f:
+        f.write("".join(f"{u}\t{i}\n" for u, i in zip(user_ids[keep].tolist(), item_ids[keep].tolist())))
+
+    return int(keep.sum())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Binary results file")
+    parser.add_argument("output_path")
+    parser.add_argument("--top-k", type=int, required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger.info("Wrote %d rows to %s", recut_rankings(args.path, args.output_path, args.top_k), args.output_path)
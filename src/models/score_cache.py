@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+import sqlite3
+
+from pathlib import Path
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_fingerprint(checkpoint_path):
+    # name, size and mtime of the checkpoint files, so an overwritten checkpoint gets a new namespace
+    path = Path(checkpoint_path)
+    if not path.is_dir():
+        return str(checkpoint_path)
+
+    entries = []
+    for file in sorted(path.iterdir()):
+        if file.is_file():
+            stat = file.stat()
+            entries.append(f"{file.name}:{stat.st_size}:{stat.st_mtime_ns}")
+
+    return f"{os.path.realpath(path)};{';'.join(entries)}"
+
+
+class ScoreCache:
+    """
+    On-disk map from hash(namespace, rendered input ids) to score with size-bounded LRU eviction.
+    """
+    def __init__(self, path, namespace, max_entries=1_000_000):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, score REAL NOT NULL, last_used INTEGER NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+        self.connection.commit()
+
+        self.namespace = hashlib.sha1(namespace.encode("utf-8")).digest()
+        self.max_entries = max_entries
+        self.clock = self.connection.execute("SELECT COALESCE(MAX(last_used), 0) FROM scores").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, input_ids):
+        return hashlib.sha1(self.namespace + np.asarray(input_ids, dtype=np.int32).tobytes()).digest()
+
+    def get_many(self, keys):
+        self.clock += 1
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT key, score FROM scores WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            found.update(rows)
+
+        self.connection.executemany(
+            "UPDATE scores SET last_used = ? WHERE key = ?", [(self.clock, key) for key in found])
+        self.connection.commit()
+
+        # per key position, a key repeated in the batch counts once per occurrence
+        hits = sum(key in found for key in keys)
+        self.hits += hits
+        self.misses += len(keys) - hits
+
+        return found
+
+    def put_many(self, items):
+        self.clock += 1
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO scores (key, score, last_used) VALUES (?, ?, ?)",
+            [(key, score, self.clock) for key, score in items])
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        size = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+        if size > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_used LIMIT ?)",
+                (size - self.max_entries,))
+
+    def close(self):
+        total = self.hits + self.misses
+        if total > 0:
+            logger.info("Score cache: %d hits, %d misses (%.1f%% hit rate)", self.hits, self.misses, 100 * self.hits / total)
+        self.connection.close()
+
+
+class CachedRankingScorer:
+    """
+    Wraps a ranking scorer, only the candidates whose rendered prompt is not cached go through the model.
+    """
+    def __init__(self, scorer, cache):
+        self.scorer = scorer
+        self.cache = cache
+
+    def __call__(self, input_ids, attention_mask):
+        keys = [
+            self.cache.key(ids[mask.bool()].tolist())
+            for ids, mask in zip(input_ids, attention_mask)
+        ]
+        cached = self.cache.get_many(keys)
+
+        # identical prompts in the same batch go through the model once
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in cached:
+                missing.setdefault(key, i)
+
+        if missing:
+            rows = list(missing.values())
+            missing_scores = self.scorer(input_ids[rows], attention_mask[rows]).float().cpu().tolist()
+            cached.update(zip(missing.keys(), missing_scores))
+            self.cache.put_many(zip(missing.keys(), missing_scores))
+
+        return torch.tensor([cached[key] for key in keys], dtype=torch.float)
@@ -0,0 +1,113 @@
+import logging
+
+import torch
+
+from ..utilities.profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+
+def get_verbalizer_token_ids(tokenizer, label_to_word, labels):
+    # the model emits the first piece of the label word at the first decoding step
+    return [tokenizer(label_to_word[label], add_special_tokens=False).input_ids[0] for label in labels]
+
+
+@torch.no_grad()
+def forward_first_step_logits(model, input_ids, attention_mask):
+    """
+    Encoder plus one decoder step from the decoder start token, returns the vocabulary logits.
+    """
+    decoder_input_ids = torch.full(
+        (input_ids.shape[0], 1), model.config.decoder_start_token_id,
+        dtype=torch.long, device=input_ids.device)
+
+    output = model(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        decoder_input_ids=decoder_input_ids,
+        use_cache=False)
+
+    return output.logits[:, 0, :]
+
+
+@torch.no_grad()
+def generate_first_step_logits(model, input_ids, attention_mask):
+    output = model.generate(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        max_new_tokens=3,
+        output_scores=True, return_dict_in_generate=True)
+
+    return output.scores[0]
+
+
+first_step_logits_mapping = {
+    "forward": forward_first_step_logits,
+    "generate": generate_first_step_logits,
+}
+
+
+def select_verbalizer_scores(logits, token_ids, score="logit"):
+    if score == "logit":
+        return logits[:, token_ids]
+    if score == "log_prob":
+        return torch.log_softmax(logits.float(), dim=-1)[:, token_ids]
+    if score == "verbalizer_log_prob":
+        return torch.log_softmax(logits[:, token_ids].float(), dim=-1)
+
+    raise ValueError("Score not found: %s" % (score))
+
+
+class RankingScorer:
+    """
+    Scores candidates with the verbalizer score of the positive label word.
+    """
+    def __init__(self, model, token_ids, positive_index, scorer="forward", score="logit", check_batches=0, quantization=None):
+        if scorer not in first_step_logits_mapping:
+            raise ValueError("Scorer not found: %s" % (scorer))
+
+        self.model = model
+        self.token_ids = token_ids
+        self.positive_index = positive_index
+        self.scorer = scorer
+        self.score = score
+        self.check_batches = check_batches
+        self.quantization = quantization
+
+    def signature(self):
+        # what determines the scores besides the checkpoint and the input ids
+        signature = f"score={self.score};token_ids={self.token_ids};positive_index={self.positive_index}"
+        # quantized models give different scores for the same inputs
+        if self.quantization is not None:
+            signature += f";quantization={self.quantization}"
+        return signature
+
+    def verbalizer_scores(self, input_ids, attention_mask, scorer=None):
+        with profiler.stage("model_forward"):
+            logits = first_step_logits_mapping[scorer or self.scorer](self.model, input_ids, attention_mask)
+        with profiler.stage("score_extraction"):
+            return select_verbalizer_scores(logits, self.token_ids, score=self.score)
+
+    def __call__(self, input_ids, attention_mask):
+        scores = self.verbalizer_scores(input_ids, attention_mask)[:, self.positive_index]
+
+        if self.check_batches > 0 and self.scorer != "generate":
+            self.check_batches -= 1
+            self.check_generate_parity(input_ids, attention_mask, scores)
+
+        return scores
+
+    def check_generate_parity(self, input_ids, attention_mask, scores):
+        generate_scores = self.verbalizer_scores(input_ids, attention_mask, scorer="generate")[:, self.positive_index]
+
+        same_ranking = torch.equal(
+            torch.argsort(scores, descending=True, stable=True),
+            torch.argsort(generate_scores, descending=True, stable=True))
+        max_diff = (scores - generate_scores).abs().max().item()
+
+        # rankings may only differ on near ties
+        if not same_ranking and not torch.allclose(scores, generate_scores, rtol=1e-4, atol=1e-4):
+            raise ValueError(
+                "Scorer %s ranks candidates differently from generate (max score difference %f)" % (self.scorer, max_diff))
+
+        logger.info("Scorer %s matches the generate ranking (max score difference %g)", self.scorer, max_diff)
@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+import urllib.request
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from transformers import set_seed, HfArgumentParser, Seq2SeqTrainingArguments
+
+from ..data.build_users_profiles import PROFILES_PATH, SPLITS, UsersProfiles
+from ..data.paths import INTERIM_DATA_PATH, PROCESSED_DATA_PATH
+from ..data.processors import STRUCTURED_ITEM_COLUMNS
+from ..data.t5dataset import is_structured_template, tokenize_multipart_input, tokenize_structured_input
+from ..data.templates import compile_template
+from ..data.text_store import open_text_store
+from ..utilities.setup_parameters import ModelArguments, DynamicDataTrainingArguments
+from .eval import load_ranking_scorer
+
+logger = logging.getLogger(__name__)
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class RankingService:
+    """
+    Online recommendations from a checkpoint loaded once, the candidates of concurrent requests
+    are scored together in micro-batches of at most max_batch_size, waiting at most max_wait seconds.
+    """
+    def __init__(self, model_args, data_args, training_args, checkpoint_path, max_batch_size, max_wait, latency_window=10000):
+        self.data_args = data_args
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # the model, the score cache connection and the tokenizer are only used from this thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor.submit(self.load, model_args, data_args, training_args, checkpoint_path).result()
+
+        self.queue = None
+        self.started = None
+        self.latencies = deque(maxlen=latency_window)
+        self.requests = 0
+        self.candidates = 0
+        self.batches = 0
+
+    def load(self, model_args, data_args, training_args, checkpoint_path):
+        self.tokenizer, self.data_collator, self.scorer, self.score_cache = load_ranking_scorer(
+            model_args, data_args, training_args, checkpoint_path)
+        self.compiled_template = compile_template(data_args.template, self.tokenizer) if data_args.pretokenize_template else None
+
+        if not PROFILES_PATH.exists():
+            raise ValueError("Users profiles not found: %s, build them with src.data.build_users_profiles" % (PROFILES_PATH))
+        liked_genres = UsersProfiles.load().liked_genres()
+        self.user_genres = dict(zip(liked_genres.user_id.tolist(), liked_genres.liked_genres.tolist()))
+
+        # users without liked genres are known too, from their interactions
+        interactions = pd.concat([
+            pd.read_csv(
+                PROCESSED_DATA_PATH / "dbbook" / f"{split_name}.tsv", sep='\t', header=None,
+                usecols=[0, 1, 4], names=['user_id', 'item_id', 'item_genre'])
+            for split_name in SPLITS
+        ])
+        self.user_ids = set(interactions.user_id.tolist())
+
+        # items are rendered from the same fields as the ranking datasets, items missing one are not rankable
+        self.structured = is_structured_template(data_args.template)
+        if self.structured:
+            self.item_features = self.load_item_features(interactions)
+            self.item_ids = set(self.item_features)
+        else:
+            self.text_store = open_text_store(PROCESSED_DATA_PATH / "dbbook")
+            self.item_ids = set(self.text_store.item_ids[self.text_store.lengths > 0].tolist())
+
+    def load_item_features(self, interactions):
+        item_features = pd.read_csv(
+            INTERIM_DATA_PATH / "dbbook" / "item-prop" / "train.tsv", sep='\t', header=None,
+            names=['item_id', 'item_author', 'item_genre', 'item_series', 'item_publisher', 'item_subject'])
+        # the genre of the interactions, as in the structured examples
+        item_genres = interactions[['item_id', 'item_genre']].dropna().drop_duplicates('item_id')
+        df = item_features.drop(columns='item_genre').merge(item_genres, on='item_id').fillna('')
+
+        columns = ['item_genre', *STRUCTURED_ITEM_COLUMNS]
+        df = df.loc[(df[columns] != '').all(axis=1), :].drop_duplicates('item_id')
+
+        return df.set_index('item_id')[columns].to_dict('index')
+
+    def score_pairs(self, pairs):
+        features = []
+        for user_id, item_id in pairs:
+            example = {
+                'user_id': user_id,
+                'item_id': item_id,
+                'user_genres': self.user_genres.get(user_id, ''),
+            }
+            if self.structured:
+                example.update(self.item_features[item_id])
+                tokenize = tokenize_structured_input
+            else:
+                example['item_text'] = self.text_store.get_text(item_id)
+                tokenize = tokenize_multipart_input
+
+            features.append(tokenize(
+                example=example,
+                tokenizer=self.tokenizer,
+                template=self.data_args.template,
+                compiled_template=self.compiled_template))
+
+        batch = self.data_collator(features)
+        return self.scorer(batch["input_ids"], batch["attention_mask"]).tolist()
+
+    async def run_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # candidates of requests that were cancelled meanwhile are not scored
+            pending = [(pair, future) for pair, future in pending if not future.done()]
+            if not pending:
+                continue
+
+            try:
+                scores = await loop.run_in_executor(self.executor, self.score_pairs, [pair for pair, _ in pending])
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), score in zip(pending, scores):
+                if not future.done():
+                    future.set_result(score)
+            self.batches += 1
+
+    async def recommend(self, user_id, candidate_item_ids, k=None):
+        if user_id not in self.user_ids:
+            raise ValueError("User not found: %s" % (user_id))
+        missing = [item_id for item_id in candidate_item_ids if item_id not in self.item_ids]
+        if missing:
+            raise ValueError("Items not found: %s" % (missing))
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for item_id in candidate_item_ids:
+            future = loop.create_future()
+            self.queue.put_nowait(((user_id, item_id), future))
+            futures.append(future)
+        scores = np.array(await asyncio.gather(*futures), dtype=np.float64)
+
+        self.candidates += len(candidate_item_ids)
+        order = np.argsort(-scores, kind="stable")[:k]
+        return [{"item_id": candidate_item_ids[i], "score": float(scores[i])} for i in order]
+
+    def metrics(self):
+        uptime = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "requests": self.requests,
+            "candidates": self.candidates,
+            "batches": self.batches,
+            "mean_batch_size": self.candidates / self.batches if self.batches else None,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "requests_per_sec": self.requests / uptime,
+            "candidates_per_sec": self.candidates / uptime,
+            "uptime_seconds": uptime,
+            # the scorer of load_ranking_scorer goes through the score cache when score_cache_path is set
+            "score_cache_hits": self.score_cache.hits if self.score_cache is not None else None,
+            "score_cache_misses": self.score_cache.misses if self.score_cache is not None else None,
+        }
+
+    async def dispatch(self, method, path, body):
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+
+        if method == "POST" and path == "/recommend":
+            start = time.perf_counter()
+            try:
+                request = json.loads(body)
+                items = await self.recommend(
+                    int(request["user_id"]),
+                    [int(item_id) for item_id in request["candidate_item_ids"]],
+                    request.get("k"))
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": str(e)}
+            except Exception as e:
+                logger.exception("Failed to serve %s %s", method, path)
+                return 500, {"error": str(e)}
+
+            self.latencies.append(time.perf_counter() - start)
+            self.requests += 1
+            return 200, {"user_id": request["user_id"], "items": items}
+
+        return 404, {"error": "Not found: %s %s" % (method, path)}
+
+    async def write_response(self, writer, status, response):
+        payload = json.dumps(response).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                request = request_line.decode("latin-1").split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                content_length = headers.get("content-length", "0")
+                if len(request) != 3 or not content_length.isdigit():
+                    # the rest of the stream can not be framed, so the connection is closed after the error
+                    await self.write_response(
+                        writer, 400, {"error": "Malformed request: %s" % (request_line.decode("latin-1").strip())})
+                    break
+
+                body = await reader.readexactly(int(content_length))
+                status, response = await self.dispatch(request[0], request[1], body)
+                await self.write_response(writer, status, response)
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        self.started = time.perf_counter()
+        batcher = asyncio.create_task(self.run_batcher())
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info("Serving recommendations on http://%s:%d", host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if self.score_cache is not None:
+                self.executor.submit(self.score_cache.close).result()
+
+
+def recommend(user_id, candidate_item_ids, k=None, host="127.0.0.1", port=8000):
+    """
+    Client of the ranking service, returns the ranked candidates with their scores.
+    """
+    request = urllib.request.Request(
+        f"http://{host}:{port}/recommend",
+        data=json.dumps({"user_id": user_id, "candidate_item_ids": list(candidate_item_ids), "k": k}).encode("utf-8"),
+        headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)["items"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--params", default="./params/flan-t5-base-dbbook-prompt-4.json")
+    parser.add_argument("--checkpoint", type=int, default=4965)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=None, help="Defaults to the eval batch size of the params")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    model_args, data_args, training_args = HfArgumentParser(
+        (ModelArguments, DynamicDataTrainingArguments, Seq2SeqTrainingArguments)).parse_json_file(args.params)
+    data_args.task_name = "dbbook_ranking"
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    set_seed(training_args.seed)
+
+    service = RankingService(
+        model_args, data_args, training_args,
+        training_args.output_dir + f'/checkpoint-{args.checkpoint}',
+        max_batch_size=args.max_batch_size or training_args.per_device_eval_batch_size,
+        max_wait=args.max_wait_ms / 1000)
+    asyncio.run(service.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from glob import glob
+from pathlib import Path
+
+import torch
+
+from transformers import AutoTokenizer, HfArgumentParser
+
+from ..utilities.setup_parameters import ModelArguments
+from .eval import run_eval, shard_cores, shard_users
+from .finetune import run_finetune
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["finetune", "eval"]
+TABLE_COLUMNS = [
+    "finetune_seconds", "train_loss", "eval_loss", "eval_acc", "eval_auc", "eval_log_loss", "eval_runtime",
+    "eval_seconds", "candidates", "candidates_per_sec", "peak_rss_mb",
+]
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(model_name_or_path):
+    # one tokenizer object per model, so compiled templates share the token ids of the fields
+    return AutoTokenizer.from_pretrained(model_name_or_path)
+
+
+def run_params_files(params_files, stages, checkpoint, threads=None, cores=None):
+    """
+    Runs the stages of the params files one after the other in this process,
+    the processors, item texts and tokenizers are loaded once and shared by all of them.
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+    rows = []
+    for params_file in params_files:
+        model_args, = HfArgumentParser((ModelArguments)).parse_json_file(params_file, allow_extra_keys=True)
+        tokenizer = load_tokenizer(model_args.model_name_or_path)
+        row = {"params_file": params_file, "name": Path(params_file).stem}
+
+        if "finetune" in stages:
+            start = time.perf_counter()
+            metrics = run_finetune(params_file, tokenizer=tokenizer)
+            row["finetune_seconds"] = time.perf_counter() - start
+            row.update({name: value for name, value in metrics.items() if name in TABLE_COLUMNS})
+
+        if "eval" in stages:
+            scaling = run_eval(params_file, checkpoint, tokenizer=tokenizer)
+            row.update(
+                eval_seconds=scaling["seconds"], candidates=scaling["candidates"],
+                candidates_per_sec=scaling["candidates_per_sec"], peak_rss_mb=scaling["peak_rss_mb"])
+
+        rows.append(row)
+
+    return rows
+
+
+def run_sweep(params_files, stages, checkpoint, workers=1, threads_per_worker=None, pin_cores=False):
+    """
+    Runs every params file, with several workers the params files are split across processes
+    pinned to disjoint core groups and each worker shares its data between its params files.
+    """
+    if workers == 1:
+        return run_params_files(params_files, stages, checkpoint, threads=threads_per_worker)
+
+    threads, cores = shard_cores(workers, threads_per_worker)
+    if not pin_cores:
+        cores = [None] * workers
+
+    # spawn, so the workers do not inherit the torch thread pools of the parent
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [
+            executor.submit(run_params_files, worker_params_files, stages, checkpoint, threads, cores[worker])
+            for worker, worker_params_files in enumerate(shard_users(params_files, workers))
+        ]
+        rows = [row for future in futures for row in future.result()]
+
+    return sorted(rows, key=lambda row: params_files.index(row["params_file"]))
+
+
+def format_table(rows):
+    columns = ["name"] + [column for column in TABLE_COLUMNS if any(column in row for row in rows)]
+
+    def format_value(value):
+        if value is None:
+            return "-"
+        return f"{value:.4g}" if isinstance(value, float) else str(value)
+
+    cells = [columns] + [[format_value(row.get(column)) for column in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(line, widths)) for line in cells)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--params", nargs="+", default=None, help="Params files, every flan-t5-base-dbbook one if not set")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--checkpoint", type=int, default=4965, help="Checkpoint step ranked by the eval stage")
+    parser.add_argument("--workers", type=int, default=1, help="Params files run concurrently in this many processes")
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--pin-cores", action="store_true", help="Pin every worker to its own group of cores")
+    parser.add_argument("--output", default="results/sweep.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    params_files = args.params or sorted(glob("./params/flan-t5-base-dbbook-*.json"))
+    if not params_files:
+        raise ValueError("Params files not found: %s" % (args.params))
+
+    start = time.perf_counter()
+    rows = run_sweep(
+        params_files, args.stages, args.checkpoint,
+        workers=args.workers, threads_per_worker=args.threads_per_worker, pin_cores=args.pin_cores)
+    elapsed = time.perf_counter() - start
+
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump({"stages": args.stages, "workers": args.workers, "seconds": elapsed, "runs": rows}, f, indent=2)
+
+    print(format_table(rows))
+    print(f"{len(rows)} params file(s) in {elapsed:.1f}s, written to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import logging
+
+import torch
+
+from torch.utils.data import DataLoader
+from transformers import Seq2SeqTrainer
+
+from ..data.samplers import LengthBucketBatchSampler
+from ..utilities.profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+
+class PromptingSeq2SeqTrainer(Seq2SeqTrainer):
+    """
+    Seq2SeqTrainer that can batch the prompting datasets by input length
+    and validate on the verbalizer logits instead of generated text.
+    """
+    def __init__(self, *args, data_args=None, verbalizer_token_ids=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data_args = data_args
+        self.verbalizer_token_ids = verbalizer_token_ids
+
+        if data_args is not None and data_args.validation_mode not in ["generate", "logits"]:
+            raise ValueError("Validation mode not found: %s" % (data_args.validation_mode))
+        if data_args is not None and data_args.validation_mode == "logits" and len(set(verbalizer_token_ids)) != len(verbalizer_token_ids):
+            raise ValueError("Label words do not start with distinct tokens: %s" % (verbalizer_token_ids))
+
+    def training_step(self, *args, **kwargs):
+        with profiler.stage("training_step"):
+            return super().training_step(*args, **kwargs)
+
+    def prediction_step(self, model, inputs, prediction_loss_only, ignore_keys=None, **gen_kwargs):
+        if self.data_args is None or self.data_args.validation_mode == "generate":
+            return super().prediction_step(model, inputs, prediction_loss_only, ignore_keys=ignore_keys, **gen_kwargs)
+
+        # one teacher-forced forward pass gives the loss, its first decoder step scores the label words
+        inputs = self._prepare_inputs(inputs)
+        with torch.no_grad():
+            with self.compute_loss_context_manager():
+                outputs = model(**inputs)
+        loss = outputs.loss.mean().detach()
+        if prediction_loss_only:
+            return loss, None, None
+
+        token_ids = torch.tensor(self.verbalizer_token_ids, device=inputs["labels"].device)
+        logits = outputs.logits[:, 0, token_ids].float()
+        # label index of every example from the first token of its label word
+        matches = inputs["labels"][:, :1] == token_ids
+        matched = matches.any(dim=-1)
+        if not matched.all():
+            unmatched = inputs["labels"][~matched, 0].unique().tolist()
+            raise ValueError("Label tokens not found in the verbalizer: %s" % (unmatched))
+        labels = matches.int().argmax(dim=-1)
+
+        return loss, logits, labels
+
+    def get_length_bucket_sampler(self, dataset, batch_size, shuffle, name):
+        batch_sampler = LengthBucketBatchSampler(
+            dataset.get_lengths(),
+            batch_size=batch_size,
+            max_tokens=self.data_args.max_tokens_per_batch,
+            shuffle=shuffle,
+            bucket_size=self.data_args.bucket_size,
+            seed=self.args.seed,
+            drop_last=self.args.dataloader_drop_last and shuffle)
+        batch_sampler.log_padding_stats(name)
+
+        return batch_sampler
+
+    def get_train_dataloader(self):
+        if self.data_args is None or not self.data_args.length_bucketing:
+            return super().get_train_dataloader()
+
+        batch_sampler = self.get_length_bucket_sampler(
+            self.train_dataset, self._train_batch_size, shuffle=True, name="train")
+
+        return self.accelerator.prepare(DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory))
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        if self.data_args is None or not self.data_args.length_bucketing or isinstance(eval_dataset, str):
+            return super().get_eval_dataloader(eval_dataset)
+
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        batch_sampler = self.get_length_bucket_sampler(
+            eval_dataset, self.args.eval_batch_size, shuffle=False, name="eval")
+
+        return self.accelerator.prepare(DataLoader(
+            eval_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory))
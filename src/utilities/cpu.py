@@ -0,0 +1,46 @@
+import dataclasses
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_supports_bf16():
+    # oneDNN runs bf16 matmuls natively from avx512 onwards, older CPUs emulate them slower than fp32
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def set_torch_threads(intra_op_threads=None, inter_op_threads=None):
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # only settable once, before the first inter-op parallel work of the process
+            logger.warning("Inter-op threads already fixed at %d, ignoring %d", torch.get_num_interop_threads(), inter_op_threads)
+
+
+def configure_cpu_training(data_args, training_args):
+    """
+    Applies the CPU performance settings of the params, returns the training arguments to train with.
+    bf16 autocast and torch.compile are the bf16 and torch_compile training arguments.
+    """
+    set_torch_threads(data_args.torch_intra_op_threads, data_args.torch_inter_op_threads)
+
+    if data_args.cpu_bf16_auto and not training_args.bf16 and not torch.cuda.is_available():
+        if cpu_supports_bf16():
+            # __post_init__ sets up the mixed precision of accelerate
+            training_args = dataclasses.replace(training_args, bf16=True)
+        else:
+            logger.info("CPU has no native bf16 support, training in fp32")
+
+    logger.info(
+        "CPU training: bf16 %s, torch.compile %s, %d intra-op and %d inter-op threads",
+        training_args.bf16, training_args.torch_compile, torch.get_num_threads(), torch.get_num_interop_threads())
+
+    return training_args
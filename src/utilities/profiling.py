@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import resource
+import time
+
+from collections import defaultdict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PROFILES_PATH = Path("results") / "profiles"
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux, children are worker processes
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_rss, children_rss) / 1024
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.seconds[self.name] += time.perf_counter() - self.start
+        self.profiler.calls[self.name] += 1
+        return False
+
+
+class StageProfiler:
+    """
+    Wall time and calls per pipeline stage plus counters, a no-op unless enabled for the run.
+    """
+    def __init__(self):
+        self.reset(enabled=False)
+
+    def reset(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(float)
+
+    def stage(self, name):
+        return Stage(self, name) if self.enabled else NULL_STAGE
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def record_padding(self, attention_mask):
+        if self.enabled:
+            self.counters["tokens"] += int(attention_mask.sum())
+            self.counters["padded_tokens"] += attention_mask.numel()
+            self.counters["batches"] += 1
+
+    def state(self):
+        return {"seconds": dict(self.seconds), "calls": dict(self.calls), "counters": dict(self.counters)}
+
+    def merge(self, state):
+        # stages timed in worker processes
+        for name, seconds in state["seconds"].items():
+            self.seconds[f"workers.{name}"] += seconds
+        for name, calls in state["calls"].items():
+            self.calls[f"workers.{name}"] += calls
+        for name, value in state["counters"].items():
+            self.counters[name] += value
+
+    def metrics(self):
+        wall_seconds = time.perf_counter() - self.started
+        metrics = {"wall_seconds": wall_seconds, "peak_rss_mb": peak_rss_mb()}
+        for name, seconds in self.seconds.items():
+            metrics[f"{name}.seconds"] = seconds
+            metrics[f"{name}.calls"] = self.calls[name]
+            metrics[f"{name}.share"] = seconds / max(wall_seconds, 1e-9)
+        metrics.update(self.counters)
+
+        if self.counters.get("padded_tokens"):
+            metrics["pad_ratio"] = 1 - self.counters["tokens"] / self.counters["padded_tokens"]
+            metrics["tokens_per_sec"] = self.counters["tokens"] / max(wall_seconds, 1e-9)
+        return metrics
+
+    def export(self, run_name, entry, params_file):
+        """
+        Logs the metrics of the run to mlflow if a tracking uri is configured, to a local JSON file otherwise.
+        """
+        if not self.enabled:
+            return
+
+        metrics = self.metrics()
+        if os.environ.get("MLFLOW_TRACKING_URI"):
+            import mlflow
+
+            active_run = mlflow.active_run()
+            with mlflow.start_run(run_name=f"{run_name}-{entry}", nested=active_run is not None):
+                mlflow.set_tags({"entry": entry, "params_file": params_file})
+                mlflow.log_metrics({f"profile.{name}": value for name, value in metrics.items()})
+            logger.info("Logged %d profile metrics to mlflow", len(metrics))
+            return
+
+        PROFILES_PATH.mkdir(parents=True, exist_ok=True)
+        path = PROFILES_PATH / f"{run_name}-{entry}.json"
+        with open(path, "w") as f:
+            json.dump({"run_name": run_name, "entry": entry, "params_file": params_file, "metrics": metrics}, f, indent=2)
+        logger.info("Wrote profile metrics to %s", path)
+
+
+class ProfiledCollator:
+    """
+    Times a data collator and records the padding of its batches.
+    """
+    def __init__(self, data_collator):
+        self.data_collator = data_collator
+
+    def __call__(self, features):
+        with profiler.stage("collation"):
+            batch = self.data_collator(features)
+        profiler.record_padding(batch["attention_mask"])
+        return batch
+
+
+NULL_STAGE = NullStage()
+profiler = StageProfiler()
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from dataclasses import dataclass, field
 
 from transformers import GlueDataTrainingArguments as DataTrainingArguments
@@ -31,3 +31,172 @@ class DynamicDataTrainingArguments(DataTrainingArguments):
         default=None,
         metadata={"help": "Label word mapping"}
     )
+
+    ranking_batching: str = field(
+        default="cross_user",
+        metadata={"help": "Ranking eval batching: 'cross_user' fills fixed-size batches with candidates "
+                  "of all users, 'per_user' batches the candidates of each user separately"}
+    )
+
+    ranking_scorer: str = field(
+        default="forward",
+        metadata={"help": "Ranking scorer: 'forward' runs the encoder and one decoder step, "
+                  "'generate' reads the first step scores of model.generate"}
+    )
+
+    ranking_score: str = field(
+        default="logit",
+        metadata={"help": "Verbalizer score used for ranking: 'logit', 'log_prob' or 'verbalizer_log_prob'"}
+    )
+
+    ranking_scorer_check_batches: int = field(
+        default=1,
+        metadata={"help": "Number of batches on which the ranking is checked against the generate scorer"}
+    )
+
+    score_cache_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Path of the on-disk score cache keyed by checkpoint, tokenizer and rendered prompt, "
+                  "disabled if not set"}
+    )
+
+    score_cache_max_entries: int = field(
+        default=1_000_000,
+        metadata={"help": "Maximum number of cached scores, least recently used ones are evicted"}
+    )
+
+    pretokenize_template: bool = field(
+        default=False,
+        metadata={"help": "Build inputs by concatenating cached token ids of template segments and fields, "
+                  "ids at segment boundaries differ from tokenizing the rendered prompt, "
+                  "so finetune and eval must use the same setting"}
+    )
+
+    feature_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory of the on-disk tokenized features cache, every split is tokenized once "
+                  "and memory-mapped on later runs, disabled if not set"}
+    )
+
+    length_bucketing: bool = field(
+        default=False,
+        metadata={"help": "Batch examples of similar length together in finetune and ranking eval"}
+    )
+
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": "With length bucketing, fill batches up to this padded token budget "
+                  "instead of the batch size"}
+    )
+
+    bucket_size: int = field(
+        default=100,
+        metadata={"help": "Number of batches sorted by length together when shuffling"}
+    )
+
+    ranking_top_k: Optional[int] = field(
+        default=None,
+        metadata={"help": "Number of items written per user in the ranking results, all candidates if not set"}
+    )
+
+    ranking_binary: bool = field(
+        default=False,
+        metadata={"help": "Also write the full rankings with their scores as binary arrays, "
+                  "so they can be re-cut at any k without re-running the model"}
+    )
+
+    cascade_prefilter: Optional[str] = field(
+        default=None,
+        metadata={"help": "Cheap first ranking stage, only its top candidates of every user are scored by the model: "
+                  "genre_overlap, popularity or item_prop, disabled if not set"}
+    )
+
+    cascade_top_m: int = field(
+        default=50,
+        metadata={"help": "Number of candidates per user kept by the cascade prefilter"}
+    )
+
+    ranking_workers: int = field(
+        default=1,
+        metadata={"help": "Number of worker processes of the ranking eval, each ranks a shard of users "
+                  "with its own model copy"}
+    )
+
+    ranking_threads_per_worker: Optional[int] = field(
+        default=None,
+        metadata={"help": "Torch intra-op threads of every ranking worker, available cores split evenly if not set"}
+    )
+
+    ranking_pin_cores: bool = field(
+        default=False,
+        metadata={"help": "Pin every ranking worker to its own group of cores"}
+    )
+
+    ranking_quantization: Optional[str] = field(
+        default=None,
+        metadata={"help": "Quantize the checkpoint for CPU ranking inference: dynamic_int8 on the Linear layers, "
+                  "full precision if not set"}
+    )
+
+    ranking_reference_results: Optional[str] = field(
+        default=None,
+        metadata={"help": "Binary results of a reference run, e.g. full precision, "
+                  "to report overlap@k and Kendall tau of the rankings against"}
+    )
+
+    ranking_backend: str = field(
+        default="torch",
+        metadata={"help": "Inference backend of the ranking eval: torch, or onnx to run the exported scoring graph "
+                  "on ONNX Runtime (export it with src.models.onnx_scoring)"}
+    )
+
+    onnx_model_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Path of the exported scoring graph, "
+                  "onnx/scorer-<ranking_score>.onnx in the checkpoint directory if not set"}
+    )
+
+    onnx_intra_op_threads: Optional[int] = field(
+        default=None,
+        metadata={"help": "Size of the ONNX Runtime intra-op thread pool, chosen by ONNX Runtime if not set"}
+    )
+
+    ranking_part_users: Optional[int] = field(
+        default=None,
+        metadata={"help": "Rank users in parts of this size, each committed atomically to results/<name>-parts "
+                  "with a manifest, so an interrupted run resumes from the last completed part, disabled if not set"}
+    )
+
+    profiling: bool = field(
+        default=False,
+        metadata={"help": "Time the hot-path stages of finetune and eval and log them with tokens/sec, pad ratio "
+                  "and peak RSS to mlflow if MLFLOW_TRACKING_URI is set, to results/profiles otherwise"}
+    )
+
+    cpu_bf16_auto: bool = field(
+        default=False,
+        metadata={"help": "Finetune with bf16 autocast, the bf16 training argument, when the CPU supports bf16 natively "
+                  "and in fp32 otherwise. torch.compile is the torch_compile training argument"}
+    )
+
+    torch_intra_op_threads: Optional[int] = field(
+        default=None,
+        metadata={"help": "Threads of torch intra-op parallelism during finetuning, chosen by torch if not set"}
+    )
+
+    torch_inter_op_threads: Optional[int] = field(
+        default=None,
+        metadata={"help": "Threads of torch inter-op parallelism during finetuning, chosen by torch if not set"}
+    )
+
+    validation_mode: str = field(
+        default="generate",
+        metadata={"help": "Dev validation during finetuning: generate and compare the decoded label words, "
+                  "or logits to compare the verbalizer logits of one forward pass and report accuracy, AUC and log-loss"}
+    )
+
+    cascade_report_m: List[int] = field(
+        default_factory=lambda: [5, 10, 20, 50, 100, 200],
+        metadata={"help": "Numbers of candidates per user at which the cascade report gives the recall loss "
+                  "and expected speedup of the prefilter, cascade_top_m is always included"}
+    )